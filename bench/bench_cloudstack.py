@@ -0,0 +1,249 @@
+#!/usr/bin/python
+
+# collectd-cloudstack - bench/bench_cloudstack.py
+#
+# Description : Offline benchmark of cloudstack.py against mock_cloudstack.py.
+#
+# Every scenario starts a mock CloudStack API serving a synthetic cloud, then
+# runs one full collection and dispatch of cloudstack.py in a fresh process
+# (so the peak RSS of a scenario is not inherited from the previous one) with
+# a stub collectd module. The figures are reported per scenario:
+#
+#   wall time      seconds spent in get_stats(), i.e. one collection cycle
+#   dispatch time  seconds spent in read_callback()
+#   requests       API calls received by the mock server
+#   bytes          response bytes sent by the mock server
+#   connections    TCP connections opened against the mock server
+#   peak RSS       maximum resident memory of the collecting process
+#   values         number of values dispatched to collectd
+#   dispatches     number of collectd.Values dispatched, lower than values with MultiValue
+#
+# With --deploy N the mock deploys N VMs after the collection, and a second
+# cycle updates the VM inventory from their events; its duration is reported
+# as the update time.
+#
+# With --source database the VM, root volume and account figures are read from
+# a sqlite copy of the synthetic cloud instead of the API. --compare runs both
+# sources on the same synthetic cloud and reports the metrics they disagree on.
+#
+# Usage: bench_cloudstack.py [--scenario small,medium] [--hosts N --vms M] [--latency S] [--source api|database] [--deploy N] [--compare] [--json]
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import urllib2
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+KEY = 'bench-key'
+SECRET = 'bench-secret'
+
+SCENARIOS = [
+    ('small', 10, 1000),
+    ('medium', 100, 10000),
+    ('large', 1000, 100000),
+    ('xlarge', 5000, 500000),
+]
+
+
+class ConfigNode(object):
+    def __init__(self, key, values, children=()):
+        self.key = key
+        self.values = values
+        self.children = list(children)
+
+
+def stub_collectd():
+    """Install a collectd module recording callbacks and counting dispatched values."""
+    module = types.ModuleType('collectd')
+    module.callbacks = {}
+    module.dispatched = [0]
+    module.dispatches = [0]
+
+    def register(kind):
+        def register_callback(callback, *args, **kwargs):
+            module.callbacks[kind] = callback
+        return register_callback
+
+    class Values(object):
+        def __init__(self, **kwargs):
+            self.values = []
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+
+        def dispatch(self, **kwargs):
+            module.dispatched[0] += len(self.values)
+            module.dispatches[0] += 1
+
+    def log(msg):
+        pass
+
+    module.register_config = register('config')
+    module.register_init = register('init')
+    module.register_read = register('read')
+    module.register_shutdown = register('shutdown')
+    module.Values = Values
+    module.error = module.warning = module.notice = module.info = module.debug = log
+    sys.modules['collectd'] = module
+    return module
+
+
+def server_stats(api):
+    return json.load(urllib2.urlopen(api.replace('/client/api', '/stats')))
+
+
+def run_collection(api, options, dump=False, deploy=0):
+    """Run one collection and dispatch in this process, return the measures
+    and, with `dump`, the collected stats (of the second cycle with `deploy`)."""
+    collectd = stub_collectd()
+    sys.path.insert(0, os.path.dirname(BENCH_DIR))
+    import cloudstack
+
+    config = [ConfigNode('Api', [api]), ConfigNode('ApiKey', [KEY]), ConfigNode('Secret', [SECRET])]
+    config.extend(ConfigNode(key, [value]) for key, value in options)
+    collectd.callbacks['config'](ConfigNode('Module', [], config))
+
+    endpoint = cloudstack.ENDPOINTS[0]
+    before = server_stats(api)
+    started = time.time()
+    stats = cloudstack.get_stats(endpoint)
+    collected = time.time()
+    endpoint.publish(stats)
+    collectd.callbacks['read']()
+    dispatched = time.time()
+    after = server_stats(api)
+    updated = 0
+    if deploy:
+        urllib2.urlopen(api.replace('/client/api', '/deploy?count=%d' % deploy)).read()
+        before_update = time.time()
+        stats = cloudstack.get_stats(endpoint)
+        updated = time.time() - before_update
+    collectd.callbacks['shutdown']()
+
+    result = {
+        'wall_time': collected - started,
+        'dispatch_time': dispatched - collected,
+        'requests': after['requests'] - before['requests'],
+        'bytes': after['bytes'] - before['bytes'],
+        # the connection of the second /stats request is not part of the collection
+        'connections': after['connections'] - before['connections'] - 1,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'values': collectd.dispatched[0],
+        'dispatches': collectd.dispatches[0],
+        'update_time': updated,
+    }
+    if dump:
+        result['stats'] = dict((metric.key, value) for metric, value in stats.items())
+    return result
+
+
+def write_sqlite(hosts, vms, path, deploy=0):
+    # the deployed VMs belong to the accounts of the initial cloud
+    subprocess.check_call([sys.executable, os.path.join(BENCH_DIR, 'mock_cloudstack.py'), '--hosts', str(hosts), '--vms', str(vms + deploy),
+                           '--accounts', str(max(1, vms // 10)), '--sqlite', path])
+    return [('Source', 'database'), ('DbDriver', 'sqlite3'), ('DbName', path)]
+
+
+def collect(api, options, dump=False, deploy=0):
+    command = [sys.executable, os.path.abspath(__file__), '--collect', api, '--deploy', str(deploy)]
+    for key, value in options:
+        command.extend(['--option', '%s=%s' % (key, value)])
+    if dump:
+        command.append('--dump')
+    return json.loads(subprocess.check_output(command))
+
+
+def run_scenario(name, hosts, vms, latency, options, source='api', compare=False, deploy=0):
+    server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'mock_cloudstack.py'), '--hosts', str(hosts), '--vms', str(vms),
+                               '--key', KEY, '--secret', SECRET, '--latency', str(latency)], stdout=subprocess.PIPE)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        api = server.stdout.readline().strip()
+        database = []
+        if source == 'database' or compare:
+            database = write_sqlite(hosts, vms, os.path.join(tmpdir, 'cloud.db'), deploy)
+        if compare:
+            # the database already holds the VMs the API collection deploys
+            result = compare_sources(collect(api, options, True, deploy)['stats'], collect(api, options + database, True)['stats'])
+        else:
+            result = collect(api, options + database if source == 'database' else options, deploy=deploy)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(tmpdir)
+    result.update({'scenario': name, 'hosts': hosts, 'vms': vms})
+    return result
+
+
+def compare_sources(api_stats, database_stats):
+    """Return the metrics both sources should agree on and the ones they differ on."""
+    keys = set(api_stats) | set(database_stats)
+    differences = dict((key, [api_stats.get(key), database_stats.get(key)]) for key in keys
+                       if api_stats.get(key) != database_stats.get(key))
+    return {'metrics': len(keys), 'differences': differences}
+
+
+def report_comparison(results):
+    for r in results:
+        print '%-8s %6d hosts %7d vms: %d metrics, %d differences' % (r['scenario'], r['hosts'], r['vms'], r['metrics'], len(r['differences']))
+        for key in sorted(r['differences']):
+            print '    %s: api %s, database %s' % (key, r['differences'][key][0], r['differences'][key][1])
+
+
+def report(results):
+    header = ('scenario', 'hosts', 'vms', 'wall (s)', 'dispatch (s)', 'requests', 'MiB sent', 'conns', 'peak RSS (MiB)', 'values', 'dispatches', 'update (s)')
+    print '%-8s %6s %7s %9s %12s %9s %9s %6s %15s %8s %11s %11s' % header
+    for r in results:
+        print '%-8s %6d %7d %9.2f %12.3f %9d %9.1f %6d %15.1f %8d %11d %11.2f' % (
+            r['scenario'], r['hosts'], r['vms'], r['wall_time'], r['dispatch_time'], r['requests'],
+            r['bytes'] / 1048576.0, r['connections'], r['peak_rss_kb'] / 1024.0, r['values'], r['dispatches'], r['update_time'])
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark cloudstack.py against a mock CloudStack API")
+    parser.add_argument('--scenario', default='small,medium', help="comma separated list among %s" % ', '.join(s[0] for s in SCENARIOS))
+    parser.add_argument('--hosts', type=int, help="custom scenario, overrides --scenario")
+    parser.add_argument('--vms', type=int)
+    parser.add_argument('--latency', type=float, default=0, help="seconds added by the mock server to every API call")
+    parser.add_argument('--option', action='append', default=[], help="cloudstack module option, e.g. MaxConcurrentPages=8")
+    parser.add_argument('--source', choices=('api', 'database'), default='api', help="where VMs, root volumes and accounts are read from")
+    parser.add_argument('--deploy', type=int, default=0, help="VMs deployed after the collection, then counted from their events")
+    parser.add_argument('--compare', action='store_true', help="check that both sources produce the same metrics")
+    parser.add_argument('--json', action='store_true', help="print one JSON document per scenario")
+    parser.add_argument('--collect', help=argparse.SUPPRESS)
+    parser.add_argument('--dump', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    options = [tuple(option.split('=', 1)) for option in args.option]
+
+    if args.collect:
+        print json.dumps(run_collection(args.collect, options, args.dump, args.deploy))
+        return
+
+    if args.hosts and args.vms:
+        scenarios = [('custom', args.hosts, args.vms)]
+    else:
+        wanted = args.scenario.split(',')
+        scenarios = [s for s in SCENARIOS if s[0] in wanted]
+
+    results = []
+    for name, hosts, vms in scenarios:
+        results.append(run_scenario(name, hosts, vms, args.latency, options, args.source, args.compare, args.deploy))
+        if args.json:
+            print json.dumps(results[-1])
+            sys.stdout.flush()
+    if args.compare:
+        if not args.json:
+            report_comparison(results)
+        sys.exit(1 if any(r['differences'] for r in results) else 0)
+    if not args.json:
+        report(results)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,427 @@
+#!/usr/bin/python
+
+# collectd-cloudstack - bench/mock_cloudstack.py
+#
+# Description : Local stand-in for the CloudStack API serving a synthetic cloud,
+# used by bench_cloudstack.py to measure cloudstack.py without a real region.
+#
+# Records are generated from their index on every request, so the size of the
+# synthetic cloud has no impact on the memory of the server. GET /deploy?count=N
+# adds N VMs to the cloud, announced by VM.CREATE events like a deployment.
+
+import base64
+import calendar
+import hashlib
+import hmac
+import json
+import sys
+import threading
+import time
+import urllib
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+DEFAULT_PAGESIZE = 500
+GiB = 1073741824
+
+# CloudStack ids are UUIDs, the synthetic ones carry their kind and index
+KINDS = {'zone': 1, 'host': 2, 'pod': 3, 'cluster': 4, 'vm': 5, 'volume': 6, 'account': 7, 'systemvm': 8, 'asyncjob': 9, 'event': 10, 'domain': 11}
+# the accounts alternate between two domains, which reuse the same account names
+DOMAINS = ['ROOT', 'customers']
+# the async jobs are created one per second from this date
+JOBS_EPOCH = 1488450030
+JOB_COMMANDS = ['org.apache.cloudstack.api.command.user.vm.DeployVMCmd', 'org.apache.cloudstack.api.command.user.vm.StopVMCmd',
+                'org.apache.cloudstack.api.command.user.vm.StartVMCmd', 'org.apache.cloudstack.api.command.user.snapshot.CreateSnapshotCmd']
+
+
+def uuid_of(kind, i):
+    return '%08x-0000-4000-8000-%012x' % (KINDS[kind], i)
+
+
+def index_of(uuid):
+    return int(uuid.rsplit('-', 1)[1], 16)
+
+
+def timestamp_of(date):
+    # "2017-03-02T10:20:30+0100" -> seconds since the epoch, ValueError on
+    # any other format like the API
+    seconds = calendar.timegm(time.strptime(date[:19], '%Y-%m-%dT%H:%M:%S'))
+    offset = int(date[19:22]) * 3600 + int(date[19] + date[22:24]) * 60
+    return seconds - offset
+
+
+def state_of(i):
+    # 80% Running, 15% Stopped, 3% Starting, 2% Stopping
+    bucket = i % 100
+    if bucket < 80:
+        return 'Running'
+    elif bucket < 95:
+        return 'Stopped'
+    elif bucket < 98:
+        return 'Starting'
+    return 'Stopping'
+
+
+class SyntheticCloud(object):
+    """A cloud of `hosts` hypervisors spread over `zones` zones running `vms` VMs."""
+
+    def __init__(self, hosts, vms, zones=None, pods=2, clusters=2, accounts=None):
+        self.nhosts = hosts
+        self.nvms = vms
+        self.nzones = zones or max(1, min(6, hosts // 10))
+        self.npods = pods
+        self.nclusters = clusters
+        self.naccounts = accounts or max(1, vms // 10)
+        self.nasyncjobs = max(10, vms // 50)
+        # (VM index, created) of the deployments, oldest first
+        self.events = []
+        self.lock = threading.Lock()
+
+    def deploy(self, count):
+        created = time.strftime('%Y-%m-%dT%H:%M:%S+0000', time.gmtime())
+        with self.lock:
+            self.events.extend((self.nvms + i, created) for i in xrange(count))
+            self.nvms += count
+            return self.nvms
+
+    def account_of(self, i):
+        # a few accounts own most of the VMs, like on a public cloud
+        return int(self.naccounts * ((i * 2654435761 % 1000003) / 1000003.0) ** 4)
+
+    def zone(self, i):
+        return {
+            'id': uuid_of('zone', i),
+            'name': 'Zone %d' % i,
+            'capacity': [{'type': 8, 'capacitytotal': 1024, 'capacityused': i, 'percentused': '%.2f' % (i / 10.24)}],
+        }
+
+    def host(self, i):
+        zone = i % self.nzones
+        pod = (i // self.nzones) % self.npods
+        cluster = (i // (self.nzones * self.npods)) % self.nclusters
+        return {
+            'id': uuid_of('host', i),
+            'name': 'Host%05d' % i,
+            'zoneid': uuid_of('zone', zone),
+            'zonename': 'Zone %d' % zone,
+            'podid': uuid_of('pod', zone * self.npods + pod),
+            'podname': 'pod%d' % pod,
+            'clusterid': uuid_of('cluster', (zone * self.npods + pod) * self.nclusters + cluster),
+            'clustername': 'cluster%d' % cluster,
+            'type': 'Routing',
+            'state': 'Up',
+            'resourcestate': 'Enabled',
+            'memorytotal': 256 * GiB,
+            'memoryused': (i % 200) * GiB,
+            'memoryallocated': (i % 220) * GiB,
+            'cpuallocated': '%d.5%%' % (i % 100),
+        }
+
+    def vm(self, i, details):
+        host = self.host(i % self.nhosts)
+        vm = {
+            'id': uuid_of('vm', i),
+            'name': 'vm%08d' % i,
+            'state': state_of(i),
+            'zoneid': host['zoneid'],
+            'zonename': host['zonename'],
+        }
+        vm.update(self.account_fields(self.account_of(i)))
+        if vm['state'] != 'Stopped':
+            vm['hostid'] = host['id']
+            vm['hostname'] = host['name']
+        if 'all' in details or 'servoff' in details:
+            vm['cpunumber'] = 1 << (i % 4)
+            vm['cpuspeed'] = 2198
+            vm['memory'] = 512 << (i % 6)
+            vm['serviceofferingid'] = 'offering-%d' % (i % 12)
+            vm['serviceofferingname'] = 'Offering %d' % (i % 12)
+        if 'all' in details:
+            vm['nic'] = [{'id': 'nic-%d' % i, 'ipaddress': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                          'macaddress': '06:00:00:%02x:%02x:%02x' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                          'networkid': 'network-0', 'isdefault': True, 'type': 'Shared', 'traffictype': 'Guest'}]
+            vm['securitygroup'] = [{'id': 'sg-0', 'name': 'default', 'ingressrule': [], 'egressrule': [], 'tags': []}]
+            vm['tags'] = [{'key': 'bench', 'value': str(i)}]
+            vm['templateid'] = 'template-0'
+            vm['templatename'] = 'Linux Ubuntu 16.04 LTS 64-bit'
+            vm['displayname'] = vm['name']
+            vm['created'] = '2017-03-02T10:20:30+0100'
+        return vm
+
+    def rootvolume(self, i):
+        host = self.host(i % self.nhosts)
+        state = state_of(i)
+        return {
+            'id': uuid_of('volume', i),
+            'name': 'ROOT-%d' % i,
+            'type': 'ROOT',
+            'zoneid': host['zoneid'],
+            'size': (10 << (i % 5)) * GiB,
+            'state': 'Ready',
+            'vmstate': state,
+            'virtualmachineid': uuid_of('vm', i),
+            'storage': host['name'].lower(),
+        }
+
+    def account_fields(self, i):
+        # the account of a resource, as listed along with it
+        return {'account': 'account%d' % (i // len(DOMAINS)), 'domainid': uuid_of('domain', i % len(DOMAINS)), 'domain': DOMAINS[i % len(DOMAINS)]}
+
+    def account(self, i):
+        fields = self.account_fields(i)
+        return {'id': uuid_of('account', i), 'name': fields['account'], 'domainid': fields['domainid'], 'domain': fields['domain'],
+                'state': 'disabled' if i % 50 == 0 else 'enabled'}
+
+    def capacity(self, i):
+        zone, kind = divmod(i, 6)
+        return {
+            'zoneid': uuid_of('zone', zone),
+            'zonename': 'Zone %d' % zone,
+            'type': (0, 1, 2, 5, 6, 9)[kind],
+            'capacitytotal': 1000000,
+            'capacityused': 1000 * (zone + kind),
+            'percentused': '%.2f' % ((zone + kind) / 10.0),
+        }
+
+    def systemvm(self, i):
+        return {'id': uuid_of('systemvm', i), 'name': 'v-%d-VM' % i, 'zonename': 'Zone %d' % i,
+                'systemvmtype': 'consoleproxy', 'activeviewersessions': i}
+
+    def asyncjob(self, i):
+        # 10% unfinished, 10% failed, the others lasted up to 10 minutes
+        created = time.gmtime(JOBS_EPOCH + i)
+        job = {
+            'jobid': uuid_of('asyncjob', i),
+            'cmd': JOB_COMMANDS[i % len(JOB_COMMANDS)],
+            'jobstatus': (0, 2)[i % 10] if i % 10 < 2 else 1,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S+0000', created),
+        }
+        if job['jobstatus']:
+            job['completed'] = time.strftime('%Y-%m-%dT%H:%M:%S+0000', time.gmtime(JOBS_EPOCH + i + (i * 7919) % 600))
+        return job
+
+    def event(self, i):
+        # listEvents returns the latest events first
+        vm, created = self.events[len(self.events) - 1 - i]
+        return {'id': uuid_of('event', len(self.events) - 1 - i), 'type': 'VM.CREATE', 'resourceid': uuid_of('vm', vm),
+                'resourcetype': 'VirtualMachine', 'state': 'Completed', 'level': 'INFO', 'created': created}
+
+    def listing(self, command, params):
+        """Return (response key, total count, record factory) of a list command."""
+        if command == 'listzones':
+            return 'zone', self.nzones, self.zone
+        elif command == 'listhosts':
+            return 'host', self.nhosts, self.host
+        elif command == 'listvirtualmachines':
+            details = params.get('details', 'all').split(',')
+            return 'virtualmachine', self.nvms, lambda i: self.vm(i, details)
+        elif command == 'listvolumes':
+            if 'virtualmachineid' in params:
+                vm = index_of(params['virtualmachineid'])
+                return 'volume', int(vm < self.nvms), lambda i: self.rootvolume(vm)
+            return 'volume', self.nvms, self.rootvolume
+        elif command == 'listaccounts':
+            return 'account', self.naccounts, self.account
+        elif command == 'listcapacity':
+            return 'capacity', self.nzones * 6, self.capacity
+        elif command == 'listsystemvms':
+            return 'systemvm', self.nzones, self.systemvm
+        elif command == 'listasyncjobs':
+            first = 0
+            if 'startdate' in params:
+                first = min(self.nasyncjobs, max(0, timestamp_of(params['startdate']) - JOBS_EPOCH))
+            return 'asyncjobs', self.nasyncjobs - first, lambda i: self.asyncjob(first + i)
+        elif command == 'listevents':
+            startdate = params.get('startdate', '')
+            count = sum(1 for vm, created in self.events if created[:19].replace('T', ' ') >= startdate)
+            return 'event', count, self.event
+        raise KeyError(command)
+
+
+def write_database(cloud, con):
+    """Load the synthetic cloud in the tables of the CloudStack database read by
+    csinstancesstats.py and by the "database" source of cloudstack.py."""
+    con.execute("CREATE TABLE data_center (id INTEGER PRIMARY KEY, uuid VARCHAR(40), name VARCHAR(255))")
+    con.execute("CREATE TABLE host (id INTEGER PRIMARY KEY, uuid VARCHAR(40), name VARCHAR(255), data_center_id INTEGER)")
+    con.execute("CREATE TABLE storage_pool (id INTEGER PRIMARY KEY, name VARCHAR(255))")
+    con.execute("CREATE TABLE service_offering (id INTEGER PRIMARY KEY, cpu INTEGER, ram_size INTEGER)")
+    con.execute("CREATE TABLE vm_instance (id INTEGER PRIMARY KEY, type VARCHAR(32), state VARCHAR(32), "
+                "data_center_id INTEGER, host_id INTEGER, service_offering_id INTEGER, account_id INTEGER, removed DATETIME)")
+    con.execute("CREATE TABLE user_vm_details (vm_id INTEGER, name VARCHAR(255), value VARCHAR(1024))")
+    con.execute("CREATE TABLE volumes (id INTEGER PRIMARY KEY, volume_type VARCHAR(64), state VARCHAR(32), size BIGINT, "
+                "data_center_id INTEGER, pool_id INTEGER, instance_id INTEGER, removed DATETIME)")
+    con.execute("CREATE TABLE account (id INTEGER PRIMARY KEY, account_name VARCHAR(100), type INTEGER, "
+                "state VARCHAR(10), domain_id INTEGER, removed DATETIME)")
+    con.execute("CREATE TABLE domain (id INTEGER PRIMARY KEY, uuid VARCHAR(40), name VARCHAR(255))")
+
+    con.executemany("INSERT INTO data_center VALUES (?, ?, ?)", ((i, cloud.zone(i)['id'], cloud.zone(i)['name']) for i in xrange(cloud.nzones)))
+    con.executemany("INSERT INTO host VALUES (?, ?, ?, ?)", ((i, cloud.host(i)['id'], cloud.host(i)['name'], i % cloud.nzones) for i in xrange(cloud.nhosts)))
+    # local storage, one pool per hypervisor named after it
+    con.executemany("INSERT INTO storage_pool VALUES (?, ?)", ((i, cloud.host(i)['name'].lower()) for i in xrange(cloud.nhosts)))
+    # offering 11 is a custom one, its VMs carry cpu and memory in user_vm_details
+    con.executemany("INSERT INTO service_offering VALUES (?, ?, ?)",
+                    ((k, 1 << (k % 4), 512 << (k % 6)) if k != 11 else (k, None, None) for k in xrange(12)))
+
+    def instances():
+        for i in xrange(cloud.nvms):
+            host = i % cloud.nhosts
+            state = state_of(i)
+            yield (i, 'User', state, host % cloud.nzones, host if state != 'Stopped' else None, i % 12, cloud.account_of(i) + 2, None)
+        for i in xrange(cloud.nzones):
+            yield (cloud.nvms + i, 'ConsoleProxy', 'Running', i, i % cloud.nhosts, None, 1, None)
+        # expunged VMs are kept with a removed date
+        yield (cloud.nvms + cloud.nzones, 'User', 'Expunging', 0, None, 0, 2, '2017-03-02 10:20:30')
+
+    def details():
+        for i in xrange(11, cloud.nvms, 12):
+            yield (i, 'cpuNumber', str(1 << (i % 4)))
+            yield (i, 'memory', str(512 << (i % 6)))
+
+    def volumes():
+        for i in xrange(cloud.nvms):
+            volume = cloud.rootvolume(i)
+            host = i % cloud.nhosts
+            yield (i, 'ROOT', volume['state'], volume['size'], host % cloud.nzones, host, i, None)
+        # root volumes of the system VMs are not listed by listVolumes
+        for i in xrange(cloud.nzones):
+            yield (cloud.nvms + i, 'ROOT', 'Ready', 2 * GiB, i, i % cloud.nhosts, cloud.nvms + i, None)
+
+    def accounts():
+        yield (1, 'system', 1, 'enabled', 1, None)
+        for i in xrange(cloud.naccounts):
+            account = cloud.account(i)
+            yield (i + 2, account['name'], 0, account['state'], i % len(DOMAINS) + 1, None)
+        # project accounts are not listed by listAccounts
+        yield (cloud.naccounts + 2, 'PrjAcct-bench', 5, 'enabled', 1, None)
+
+    con.executemany("INSERT INTO vm_instance VALUES (?, ?, ?, ?, ?, ?, ?, ?)", instances())
+    con.executemany("INSERT INTO user_vm_details VALUES (?, ?, ?)", details())
+    con.executemany("INSERT INTO volumes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", volumes())
+    con.executemany("INSERT INTO account VALUES (?, ?, ?, ?, ?, ?)", accounts())
+    con.executemany("INSERT INTO domain VALUES (?, ?, ?)", ((d + 1, uuid_of('domain', d), name) for d, name in enumerate(DOMAINS)))
+    con.commit()
+
+
+def cs_encode(value):
+    return urllib.quote(value, safe='*')
+
+
+def signature(params, secret):
+    query = '&'.join('='.join((key, cs_encode(value))) for key, value in sorted(params.items()) if key != 'signature')
+    return base64.b64encode(hmac.new(secret, msg=query.lower(), digestmod=hashlib.sha1).digest()).strip()
+
+
+class MockCloudStackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections', 0)
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, body):
+        payload = json.dumps(body, separators=(',', ':'))
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        return len(payload)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/stats':
+            self.reply(200, self.server.snapshot())
+            return
+        params = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        if url.path == '/deploy':
+            self.reply(200, {'vms': self.server.cloud.deploy(int(params.get('count', 1)))})
+            return
+        self.server.count('requests', self.api_call(params))
+
+    def api_call(self, params):
+        command = params.get('command', '').lower()
+        responsename = '%sresponse' % command
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if params.get('apiKey') != self.server.key or params.get('signature') != signature(params, self.server.secret):
+            return self.reply(401, {responsename: {'errorcode': 401, 'errortext': 'unable to verify user credentials and/or request signature'}})
+
+        try:
+            key_name, count, factory = self.server.cloud.listing(command, params)
+        except KeyError:
+            return self.reply(432, {responsename: {'errorcode': 432, 'errortext': 'The given command does not exist'}})
+        except ValueError:
+            return self.reply(431, {responsename: {'errorcode': 431, 'errortext': 'Unable to parse date'}})
+
+        pagesize = int(params.get('pagesize', DEFAULT_PAGESIZE))
+        start = (int(params.get('page', 1)) - 1) * pagesize
+        if 'ids' in params or 'id' in params:
+            indexes = [index_of(i) for i in params.get('ids', params.get('id')).split(',')]
+            indexes = [i for i in indexes if i < count]
+            count = len(indexes)
+            selected = indexes[start:start + pagesize]
+        else:
+            selected = xrange(start, min(start + pagesize, count))
+
+        body = {}
+        if selected:
+            body = {'count': count, key_name: [factory(i) for i in selected]}
+        return self.reply(200, {responsename: body})
+
+
+class MockCloudStackServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cloud, key, secret, latency=0):
+        HTTPServer.__init__(self, address, MockCloudStackHandler)
+        self.cloud = cloud
+        self.key = key
+        self.secret = secret
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'bytes': 0, 'connections': 0}
+
+    def count(self, counter, size):
+        with self.lock:
+            self.stats[counter] += 1
+            self.stats['bytes'] += size
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve a synthetic cloud through a mock CloudStack API")
+    parser.add_argument('--hosts', type=int, default=10)
+    parser.add_argument('--vms', type=int, default=1000)
+    parser.add_argument('--zones', type=int, default=None)
+    parser.add_argument('--accounts', type=int, default=None, help="number of accounts, a tenth of the VMs by default")
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--key', default='bench-key')
+    parser.add_argument('--secret', default='bench-secret')
+    parser.add_argument('--latency', type=float, default=0, help="seconds added to every API call")
+    parser.add_argument('--sqlite', help="write the synthetic cloud to this sqlite database instead of serving it")
+    args = parser.parse_args(argv)
+
+    if args.sqlite:
+        import sqlite3
+        write_database(SyntheticCloud(args.hosts, args.vms, args.zones, accounts=args.accounts), sqlite3.connect(args.sqlite))
+        return
+
+    server = MockCloudStackServer(('127.0.0.1', args.port), SyntheticCloud(args.hosts, args.vms, args.zones, accounts=args.accounts),
+                                  args.key, args.secret, args.latency)
+    # the benchmark harness reads the port from the first line
+    print 'http://127.0.0.1:%d/client/api' % server.server_address[1]
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -5,16 +5,34 @@
 # inspired by collectd-haproxy from Michael Leinartas - https://github.com/mleinart/collectd-haproxy
 
 from __future__ import division
+import array
+import binascii
+import calendar
+import copy
+import heapq
+import marshal
+import math
+import os
 import re
-import collectd
+import sys
+import threading
+import time
+from collections import namedtuple
+from itertools import izip
+import Queue
 try:
+    import collectd
+except ImportError:
+    # not running inside collectd, e.g. in cloudstack_exporter.py
+    collectd = None
+from cloudstackdb import Database, mysql_connect, sqlite_connect
+try:
+    import requests
     from cs import CloudStack
 except ImportError:
     print "Oupss, it looks like CS client isn't installed. Please install it using pip install cs"
     raise
 
-RUN = 0
-
 NAME = 'cloudstack'
 
 DEFAULT_API = 'http://localhost:8096/client/api'
@@ -22,6 +40,28 @@ DEFAULT_AUTH = False
 DEFAULT_APIKEY = ''
 DEFAULT_SECRET = ''
 VERBOSE_LOGGING = False
+MAX_CONCURRENT_PAGES = 4
+POOL_SIZE = 4
+API_TIMEOUT = 300
+FETCH_TIMEOUT = 300
+RESYNC_INTERVAL = 3600
+COLLECT_INTERVAL = 100
+MAX_SNAPSHOT_AGE = 600
+MULTI_VALUE = False
+HEARTBEAT = 0
+CACHE_DIRECTORY = ''
+CACHE_INTERVAL = 60
+ASYNC_JOBS_WINDOW = 3600
+TOP_ACCOUNTS = 10
+SOURCE = 'api'
+DB_DRIVER = 'mysql'
+DB_HOST = ''
+DB_USER = ''
+DB_PWD = ''
+DB_NAME = ''
+ENDPOINT_WORKERS = 6
+WORKERS = None
+ENDPOINTS = []
 
 METRIC_TYPES = {
     'memoryused': ('h_memory_used', 'memory'),
@@ -69,221 +109,1367 @@ METRIC_TYPES = {
     'zonecapadiskalloctotal': ('z_capacity_allocated_disk_total', 'current'),
     'zonecapadiskallocused': ('z_capacity_allocated_disk_used', 'current'),
     'zonecapadiskallocpercentused': ('z_capacity_allocated_disk_percent-used', 'current'),
-    'asyncjobscount': ('g_async_jobs_count', 'current')
+    'hvmcpu': ('h_vm_cpu', 'current'),
+    'hvmram': ('h_vm_ram', 'memory'),
+    'clustervmtotal': ('c_vm_total', 'current'),
+    'clustervmtotalrunning': ('c_vm_total_running', 'current'),
+    'clustervmtotalstarting': ('c_vm_total_starting', 'current'),
+    'clustervmtotalstopping': ('c_vm_total_stopping', 'current'),
+    'clustervmtotalstopped': ('c_vm_total_stopped', 'current'),
+    'clustervmcpu': ('c_vm_cpu', 'current'),
+    'clustervmram': ('c_vm_ram', 'memory'),
+    'podvmtotal': ('p_vm_total', 'current'),
+    'podvmtotalrunning': ('p_vm_total_running', 'current'),
+    'podvmtotalstarting': ('p_vm_total_starting', 'current'),
+    'podvmtotalstopping': ('p_vm_total_stopping', 'current'),
+    'podvmtotalstopped': ('p_vm_total_stopped', 'current'),
+    'podvmcpu': ('p_vm_cpu', 'current'),
+    'podvmram': ('p_vm_ram', 'memory'),
+    'zonevmcpu': ('z_vm_cpu', 'current'),
+    'zonevmram': ('z_vm_ram', 'memory'),
+    'asyncjobstotal': ('g_async_jobs_total', 'current'),
+    'asyncjobscount': ('g_async_jobs_count', 'current'),
+    'asyncjobsdurationp50': ('g_async_jobs_duration_p50', 'duration'),
+    'asyncjobsdurationp95': ('g_async_jobs_duration_p95', 'duration'),
+    'asyncjobsdurationp99': ('g_async_jobs_duration_p99', 'duration'),
+    'topaccountvmtotal': ('a_vm_total', 'current'),
+    'topaccountvmcpu': ('a_vm_cpu', 'current'),
+    'topaccountvmram': ('a_vm_ram', 'memory'),
+    'snapshotage': ('snapshot_age', 'duration')
+}
+
+# multi-value data sets of cloudstack_types.db and their values
+VALUE_SETS = {
+    'cloudstack_vm_states': ('running', 'starting', 'stopping', 'stopped'),
+    'cloudstack_capacity': ('total', 'used', 'percent'),
+    'cloudstack_memory': ('total', 'used', 'allocated'),
+    'cloudstack_vm_resources': ('total', 'cpu', 'ram'),
 }
 
+# with MultiValue, the metrics of an entity dispatched together as one data
+# set: metric root -> (set root, set type_instance, data set, position)
+METRIC_SETS = {}
+for setroot, type_instance, dataset, roots in [
+        ('hvmstates', 'h_vm_states', 'cloudstack_vm_states', ('hvmtotalrunning', 'hvmtotalstarting', 'hvmtotalstopping', 'hvmtotalstopped')),
+        ('clustervmstates', 'c_vm_states', 'cloudstack_vm_states', ('clustervmtotalrunning', 'clustervmtotalstarting', 'clustervmtotalstopping', 'clustervmtotalstopped')),
+        ('podvmstates', 'p_vm_states', 'cloudstack_vm_states', ('podvmtotalrunning', 'podvmtotalstarting', 'podvmtotalstopping', 'podvmtotalstopped')),
+        ('zonevmstates', 'z_vm_states', 'cloudstack_vm_states', ('zonevmtotalrunning', 'zonevmtotalstarting', 'zonevmtotalstopping', 'zonevmtotalstopped')),
+        ('hvmresources', 'h_vm_resources', 'cloudstack_vm_resources', ('hvmtotal', 'hvmcpu', 'hvmram')),
+        ('clustervmresources', 'c_vm_resources', 'cloudstack_vm_resources', ('clustervmtotal', 'clustervmcpu', 'clustervmram')),
+        ('podvmresources', 'p_vm_resources', 'cloudstack_vm_resources', ('podvmtotal', 'podvmcpu', 'podvmram')),
+        ('zonevmresources', 'z_vm_resources', 'cloudstack_vm_resources', ('zonevmtotal', 'zonevmcpu', 'zonevmram')),
+        ('memory', 'h_memory', 'cloudstack_memory', ('memorytotal', 'memoryused', 'memoryallocated')),
+        ('zonepublicip', 'z_public_ip', 'cloudstack_capacity', ('zonepubliciptotal', 'zonepublicipallocated', 'zonepublicippercent')),
+        ('zonecapamemory', 'z_capacity_memory', 'cloudstack_capacity', ('zonecapamemorytotal', 'zonecapamemoryused', 'zonecapamemorypercentused')),
+        ('zonecapacpu', 'z_capacity_cpu', 'cloudstack_capacity', ('zonecapacputotal', 'zonecapacpuused', 'zonecapacpupercentused')),
+        ('zonecapadisk', 'z_capacity_disk', 'cloudstack_capacity', ('zonecapadisktotal', 'zonecapadiskused', 'zonecapadiskpercentused')),
+        ('zonecapaprivateip', 'z_capacity_privateip', 'cloudstack_capacity', ('zonecapaprivateiptotal', 'zonecapaprivateipused', 'zonecapaprivateippercentused')),
+        ('zonecapass', 'z_capacity_SSdisk', 'cloudstack_capacity', ('zonecapasstotal', 'zonecapassused', 'zonecapasspercentused')),
+        ('zonecapadiskalloc', 'z_capacity_allocated_disk', 'cloudstack_capacity', ('zonecapadiskalloctotal', 'zonecapadiskallocused', 'zonecapadiskallocpercentused'))]:
+    for position, root in enumerate(roots):
+        METRIC_SETS[root] = (setroot, type_instance, dataset, position)
+
 METRIC_DELIM = '.'
 
+# a metric of an entity: `key` is its dotted name in get_stats() (entity path
+# and metric root), `type_instance` and `type` are what collectd receives,
+# `valueset` the (multi-value Metric, position) it belongs to, if any
+Metric = namedtuple('Metric', ['path', 'root', 'key', 'type_instance', 'type', 'valueset'])
+
+
+class MetricRegistry(object):
+    """Names of the entities and their metrics, built once for the lifetime of the process.
+
+    get_stats() keys its stats by the Metric records of this registry, so
+    dispatching them needs neither string building nor parsing. The metric
+    paths of a region registry start with the region name.
+    """
+
+    def __init__(self, prefix=(), names=None, slugs=None):
+        self.prefix = prefix
+        self.names = dict() if names is None else names
+        self.slugs = dict() if slugs is None else slugs
+        self.metrics = dict()
+
+    def region(self, name):
+        # the normalized names are shared by all the regions
+        return MetricRegistry(self.prefix + (name,), self.names, self.slugs)
+
+    def lower(self, name):
+        try:
+            return self.names[name]
+        except KeyError:
+            return self.names.setdefault(name, name.lower())
+
+    def slug(self, name):
+        # lowercased, with runs of whitespace replaced by a dash
+        try:
+            return self.slugs[name]
+        except KeyError:
+            return self.slugs.setdefault(name, re.sub(r"\s+", '-', name.lower()))
+
+    def host_path(self, host):
+        return (self.lower(host['name']), self.lower(host['podname']), self.slug(host['zonename']))
+
+    def metric(self, path, root):
+        try:
+            return self.metrics[path, root]
+        except KeyError:
+            pass
+        type_instance, val_type = METRIC_TYPES[root]
+        valueset = None
+        if root in METRIC_SETS:
+            setroot, settype_instance, dataset, position = METRIC_SETS[root]
+            # the per zone metrics repeat their root at the head of their path
+            setpath = (setroot,) + path[1:] if path[0] == root else path
+            valueset = (self.value_set(setpath, setroot, settype_instance, dataset), position)
+        fullpath = self.prefix + path
+        metric = Metric(fullpath, root, METRIC_DELIM.join(fullpath + (root,)), METRIC_DELIM.join(fullpath + (type_instance,)), val_type, valueset)
+        return self.metrics.setdefault((path, root), metric)
+
+    def value_set(self, path, root, type_instance, dataset):
+        try:
+            return self.metrics[path, root]
+        except KeyError:
+            pass
+        fullpath = self.prefix + path
+        metric = Metric(fullpath, root, METRIC_DELIM.join(fullpath + (root,)), METRIC_DELIM.join(fullpath + (type_instance,)), dataset, None)
+        return self.metrics.setdefault((path, root), metric)
+
+
+REGISTRY = MetricRegistry()
+
+# immutable result of a collection cycle, published by the collector thread:
+# the (metric, values) pairs to dispatch
+Snapshot = namedtuple('Snapshot', ['timestamp', 'values'])
+STOP_COLLECTOR = threading.Event()
+
 hypervisors = []
 
 
-def cs_list(method, key_name, **kwargs):
-    timeout = 300
-    cs = CloudStack(endpoint=API_MONITORS, key=APIKEY_MONITORS, secret=SECRET_MONITORS, timeout=timeout)
-    querypage = 1
+def run_parallel(func, items, workers):
+    # run func over items with at most `workers` threads, results keep the order of items
+    results = [None] * len(items)
+    errors = []
+    pending = Queue.Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    def worker():
+        while not errors:
+            try:
+                index, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+class KeepAliveSession(requests.Session):
+    # cs wraps every request in "with self.session", which would close the
+    # pooled connections after each call
+    def __init__(self):
+        requests.Session.__init__(self)
+        self.response_bytes = 0
+        self.hooks['response'].append(self._measure)
+
+    def __exit__(self, *args):
+        pass
+
+    def _measure(self, response, *args, **kwargs):
+        self.response_bytes += len(response.content)
+
+
+def percentile(values, q):
+    # nearest-rank percentile of sorted values
+    return values[max(0, int(math.ceil(q / 100 * len(values))) - 1)]
+
+
+def same_values(values, others):
+    # the unset members of a value set are NaN, equal to each other here
+    return len(values) == len(others) and all(x == y or (x != x and y != y) for x, y in zip(values, others))
+
+
+class SelfStats(object):
+    """Cost of the plugin itself, dispatched under the "self" plugin instance.
+
+    API calls are accounted per method: latency percentiles over the calls
+    since the previous dispatch, and cumulative page, item, byte and error
+    counters. Gauges keep the last measure of each named step, and probes
+    read the cumulative counters kept by other objects when collected.
+    """
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = dict()
+        self.counters = dict()
+        self.gauges = dict()
+        self.probes = dict()
+
+    def _add(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def api_call(self, method, latency, size, failed):
+        with self.lock:
+            self.latencies.setdefault(method, []).append(latency)
+            self._add('%s-pages' % method, 1)
+            self._add('%s-bytes' % method, size)
+            self._add('%s-errors' % method, 1 if failed else 0)
+
+    def items(self, method, count):
+        with self.lock:
+            self._add('%s-items' % method, count)
+
+    def duration(self, name, seconds):
+        with self.lock:
+            self.gauges[name] = ('duration', seconds)
+
+    def count(self, name, value):
+        with self.lock:
+            self.gauges[name] = ('count', value)
+
+    def probe(self, name, read):
+        with self.lock:
+            self.probes[name] = read
+
+    def collect(self):
+        # (type, type_instance, value) of every measure, latencies are reset
+        with self.lock:
+            latencies, self.latencies = self.latencies, dict()
+            values = [('derive', name, value) for name, value in self.counters.items()]
+            values.extend((val_type, name, value) for name, (val_type, value) in self.gauges.items())
+            probes = self.probes.items()
+        values.extend(('derive', name, read()) for name, read in probes)
+        for method, samples in latencies.items():
+            samples.sort()
+            for q in self.PERCENTILES:
+                values.append(('duration', '%s-latency-p%d' % (method, q), percentile(samples, q)))
+        return values
+
+
+SELF_STATS = SelfStats()
+
+
+class ClientPool(object):
+    """Pool of CloudStack clients, each holding one keep-alive HTTP connection.
+
+    Clients are created lazily up to `size` and shared by all the pages and
+    list calls of a cycle. A client whose call failed is dropped together
+    with its connection and replaced by a fresh one. The calls, handshakes
+    and reconnects are accounted in `stats`, and a list call fetches at most
+    `max_concurrent_pages` pages at once.
+    """
+
+    def __init__(self, endpoint, key, secret, size, timeout, max_concurrent_pages=MAX_CONCURRENT_PAGES, stats=None):
+        self.endpoint = endpoint
+        self.key = key
+        self.secret = secret
+        self.size = size
+        self.timeout = timeout
+        self.max_concurrent_pages = max_concurrent_pages
+        self.stats = SELF_STATS if stats is None else stats
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+        self.clients = []
+        self.reconnects = 0
+        self.retired_handshakes = 0
+        self.stats.probe('client-handshakes', self.handshakes)
+        self.stats.probe('client-reconnects', lambda: self.reconnects)
+
+    def _new_client(self):
+        session = KeepAliveSession()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return CloudStack(endpoint=self.endpoint, key=self.key, secret=self.secret, timeout=self.timeout, session=session)
+
+    def acquire(self):
+        with self.lock:
+            if self.idle.empty() and len(self.clients) < self.size:
+                client = self._new_client()
+                self.clients.append(client)
+                return client
+        return self.idle.get()
+
+    def release(self, client, failed=False):
+        if failed:
+            with self.lock:
+                self.retired_handshakes += self._session_handshakes(client.session)
+                self.reconnects += 1
+                client.session.close()
+                self.clients.remove(client)
+                client = self._new_client()
+                self.clients.append(client)
+        self.idle.put(client)
+
+    def call(self, method, **kwargs):
+        client = self.acquire()
+        client.session.response_bytes = 0
+        started = time.time()
+        try:
+            response = getattr(client, method)(**kwargs)
+        except Exception:
+            self.stats.api_call(method, time.time() - started, client.session.response_bytes, True)
+            self.release(client, failed=True)
+            raise
+        self.stats.api_call(method, time.time() - started, client.session.response_bytes, False)
+        self.release(client)
+        return response
+
+    @staticmethod
+    def _session_handshakes(session):
+        # every new connection opened by urllib3 is a TCP (and TLS) handshake
+        handshakes = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for poolkey in pools.keys():
+                handshakes += pools[poolkey].num_connections
+        return handshakes
+
+    def handshakes(self):
+        with self.lock:
+            return self.retired_handshakes + sum(self._session_handshakes(client.session) for client in self.clients)
+
+    def close(self):
+        with self.lock:
+            for client in self.clients:
+                client.session.close()
+
+
+def cs_iter(client, method, key_name, **kwargs):
+    # yield the items of a list call page by page, at most
+    # client.max_concurrent_pages pages are held in memory at any time
     querypagesize = 500
-    values = getattr(cs, method)(listall='true', pagesize=querypagesize, page=querypage, **kwargs).get(key_name, [])
+    concurrency = client.max_concurrent_pages
 
-    if len(values) == querypagesize:
-        all_values = []
-        query_tmp = values
-        while len(query_tmp):
-            all_values.extend(query_tmp)
-            querypage = querypage + 1
-            query_tmp = getattr(cs, method)(listall='true', pagesize=querypagesize, page=querypage, **kwargs).get(key_name, [])
-        values = all_values
+    def fetch_page(querypage):
+        return client.call(method, listall='true', pagesize=querypagesize, page=querypage, **kwargs).get(key_name, [])
 
-    return values
+    response = client.call(method, listall='true', pagesize=querypagesize, page=1, **kwargs)
+    pages = [response.get(key_name, [])]
+    lastpage = int(math.ceil(response.get('count', len(pages[0])) / querypagesize))
+    del response
 
+    querypage = 1
+    seen = set()
+    while True:
+        client.stats.items(method, sum(len(page) for page in pages))
+        # items can move between pages during the listing, keep the first occurrence
+        for page in pages:
+            for value in page:
+                if 'id' in value:
+                    if value['id'] in seen:
+                        continue
+                    seen.add(value['id'])
+                yield value
 
-def get_stats():
-    stats = dict()
-    hvmrunning = dict()
-    hvmstopped = dict()
-    hvmstopping = dict()
-    hvmstarting = dict()
+        if len(pages[-1]) < querypagesize:
+            return
 
-    logger('verb', "get_stats calls API %s KEY %s SECRET %s" % (API_MONITORS, APIKEY_MONITORS, SECRET_MONITORS))
+        # the first page tells us how many pages there are, fetch them
+        # concurrently; past that, the listing has grown while we were paging
+        batch = range(querypage + 1, max(lastpage, querypage + 1) + 1)[:concurrency]
+        pages = run_parallel(fetch_page, batch, concurrency)
+        querypage = batch[-1]
 
-    try:
-        logger('verb', "Performing listhosts API call")
-        hypervisors = cs_list('listHosts', 'host', type='Routing', resourcestate='Enabled', state='Up')
-        logger('verb', "Completed listhosts API call")
 
-    except Exception:
-        logger('warn', "status err Unable to connect to CloudStack URL at %s for Hosts" % API_MONITORS)
+def cs_list(client, method, key_name, **kwargs):
+    return list(cs_iter(client, method, key_name, **kwargs))
+
+
+VM_STATES = ('Running', 'Starting', 'Stopping', 'Stopped')
+
+# servoff is the lightest projection still carrying cpunumber and memory
+VM_LIST_ARGS = {'details': 'servoff'}
+ROOTVOLUME_LIST_ARGS = {'type': 'ROOT'}
+
+
+def new_state_counters():
+    return dict((state, 0) for state in VM_STATES)
+
 
+def new_vm_counters():
+    counters = new_state_counters()
+    counters.update({'total': 0, 'cpu': 0, 'ram': 0})
+    return counters
+
+
+def count_vm(zonevms, hostvms, storagevms, vm, sign, n=1):
+    # add (sign=1) or remove (sign=-1) n VMs from the counters of their zone
+    # and of the host they are placed on, or of the storage (hypervisor) of
+    # their root volume for the VMs without a host, so that every VM is
+    # counted on one host at most; cpunumber and memory are the totals of
+    # those n VMs
+    zoneid, state, cpunumber, memory, hostid, storage = vm
+    placement = (hostvms, hostid) if hostid is not None else (storagevms, storage)
+    for counters, key in ((zonevms, zoneid), placement):
+        if key is None:
+            continue
+        vms = counters.get(key)
+        if vms is None:
+            vms = counters[key] = new_vm_counters()
+        vms['total'] += sign * n
+        vms['cpu'] += sign * cpunumber
+        vms['ram'] += sign * memory
+        if state in vms:
+            vms[state] += sign * n
+
+
+def count_rootvolume(zonevolumes, volume, sign, n=1):
+    # sizes are grouped by zoneid, size is the total of the n volumes
+    zoneid, size = volume
+    volumes = zonevolumes.get(zoneid)
+    if volumes is None:
+        volumes = zonevolumes[zoneid] = {'count': 0, 'size': 0}
+    volumes['count'] += sign * n
+    volumes['size'] += sign * size
+
+
+def placement_storage(rootvolume):
+    # the storage a VM without a host is counted on, none for a volume
+    # still Allocated, which lives on no storage yet
+    if rootvolume.get('state') == 'Allocated':
+        return None
+    return rootvolume.get('storage')
+
+
+def aggregate_accounts(accounts):
+    counters = {'total': 0, 'enabled': 0, 'disabled': 0}
+    for account in accounts:
+        counters['total'] += 1
+        if account['state'] in counters:
+            counters[account['state']] += 1
+    return counters
+
+
+# levels the per host counters are rolled up to, with the listHosts field naming them
+ROLLUP_LEVELS = (('cluster', 'clusterid'), ('pod', 'podid'))
+
+
+def rollup_hosts(hypervisors, hostcounters):
+    """Sum the counters of every host into its cluster and pod.
+
+    `hostcounters` maps a host id to the counters of the VMs attributed to
+    it, the same ones the host metrics report, so every level adds up.
+    Returns {level: {id: (host, counters)}}, `host` being one of the hosts
+    of the entity, which carries its names.
+    """
+    rollups = dict((level, dict()) for level, key in ROLLUP_LEVELS)
     for h in hypervisors:
-        metricnameMemUsed = METRIC_DELIM.join([h['name'].lower(), h['podname'].lower(), re.sub(r"\s+", '-', h['zonename'].lower()), 'memoryused'])
-        metricnameMemTotal = METRIC_DELIM.join([h['name'].lower(), h['podname'].lower(), re.sub(r"\s+", '-', h['zonename'].lower()), 'memorytotal'])
-        metricnameMemAlloc = METRIC_DELIM.join([h['name'].lower(), h['podname'].lower(), re.sub(r"\s+", '-', h['zonename'].lower()), 'memoryallocated'])
-        metricnameCpuAlloc = METRIC_DELIM.join([h['name'].lower(), h['podname'].lower(), re.sub(r"\s+", '-', h['zonename'].lower()), 'cpuallocated'])
-        # metricnameDiskAlloc = METRIC_DELIM.join([h['name'].lower(), h['podname'].lower(), re.sub(r"\s+", '-', h['zonename'].lower()), 'disksizeallocated'])
-        # metricnameDiskTotal = METRIC_DELIM.join([h['name'].lower(), h['podname'].lower(), re.sub(r"\s+", '-', h['zonename'].lower()), 'disksizetotal'])
-    try:
-        stats[metricnameMemUsed] = h['memoryused']
-        stats[metricnameMemTotal] = h['memorytotal']
-        stats[metricnameMemAlloc] = h['memoryallocated']
-        cpuallocated = h['cpuallocated'].replace("%", "")
-        stats[metricnameCpuAlloc] = cpuallocated
-        logger('verb', "readings :  %s memory used %s " % (h['name'], h['memoryused']))
-
-    except (TypeError, ValueError):
-        pass
+        vms = hostcounters.get(h['id'])
+        for level, key in ROLLUP_LEVELS:
+            entity = rollups[level].get(h[key])
+            if entity is None:
+                entity = rollups[level][h[key]] = (h, new_vm_counters())
+            if vms is not None:
+                counters = entity[1]
+                for counter in counters:
+                    counters[counter] += vms[counter]
+    return rollups
 
-    # collect number of active console sessions
-    try:
-        logger('verb', "Performing listSystemVms API call")
-        systemvms = cs_list('listSystemVms', 'systemvm', systemvmtype='consoleproxy')
-        logger('verb', "Completed listSystemVms API call")
 
-    except Exception:
-        logger('warn', "status err Unable to connect to CloudStack URL at %s for SystemVms" % API_MONITORS)
+def event_time(created):
+    # "2017-03-02T10:20:30+0100" -> "2017-03-02 10:20:30", the startdate format of listEvents
+    return created[:19].replace('T', ' ')
 
-    for systemvm in systemvms:
-        metricnameSessions = METRIC_DELIM.join(['activeviewersessions', systemvm['zonename'].lower(), systemvm['name'].lower(), 'activeviewersessions'])
-        if 'activeviewersessions' in systemvm:
-            stats[metricnameSessions] = systemvm['activeviewersessions']
 
-    # collect number of zones, available public ips and VMs
-    try:
-        logger('verb', "Performing listZones API call")
-        zones = cs_list('listZones', 'zone', showcapacities='true')
-        logger('verb', "Completed listZones API call")
+def api_timestamp(date):
+    # "2017-03-02T10:20:30+0100" -> seconds since the epoch, without strptime
+    # which is not thread safe in python 2
+    seconds = calendar.timegm((int(date[0:4]), int(date[5:7]), int(date[8:10]), int(date[11:13]), int(date[14:16]), int(date[17:19]), 0, 0, 0))
+    offset = int(date[20:22]) * 3600 + int(date[22:24]) * 60 if len(date) >= 24 else 0
+    return seconds + offset if date[19:20] == '-' else seconds - offset
 
-    except Exception:
-        logger('warn', "status err Unable to connect to CloudStack URL at %s for ListZone" % API_MONITORS)
 
-    for zone in zones:
-        metricnameIpAllocated = METRIC_DELIM.join(['zonepublicipallocated', zone['name'].lower(),  'zonepublicipallocated'])
-        metricnameIpTotal = METRIC_DELIM.join(['zonepubliciptotal', zone['name'].lower(),  'zonepubliciptotal'])
-        metricnameIpAllocatedPercent = METRIC_DELIM.join(['zonepublicippercent', zone['name'].lower(),  'zonepublicippercent'])
-        metricnameVmZoneTotalRunning = METRIC_DELIM.join(['zonevmtotalrunning', zone['name'].lower(),  'zonevmtotalrunning'])
-        metricnameVmZoneTotalStopped = METRIC_DELIM.join(['zonevmtotalstopped', zone['name'].lower(),  'zonevmtotalstopped'])
-        metricnameVmZoneTotalStopping = METRIC_DELIM.join(['zonevmtotalstopping', zone['name'].lower(),  'zonevmtotalstopping'])
-        metricnameVmZoneTotalStarting = METRIC_DELIM.join(['zonevmtotalstarting', zone['name'].lower(),  'zonevmtotalstarting'])
-        metricnameVmZoneTotal = METRIC_DELIM.join(['zonevmtotal', zone['name'].lower(),  'zonevmtotal'])
-        metricnameZonesCount = METRIC_DELIM.join(['zonescount',  'zonescount'])
-        metricnameHostZoneTotal = METRIC_DELIM.join(['zonehosttotal', zone['name'].lower(),  'zonehosttotal'])
-        metricnameVMZoneRAMavgSize = METRIC_DELIM.join(['zonevmramavgsize', zone['name'].lower(),  'zonevmramavgsize'])
-        metricnameVMZoneCPUavgSize = METRIC_DELIM.join(['zonevmcpuavgsize', zone['name'].lower(),  'zonevmcpuavgsize'])
-
-        # collect number of virtual machines
+class ListResource(object):
+    """A list call whose items are reduced by `aggregate` as the pages arrive."""
+
+    def __init__(self, client, method, key_name, kwargs, aggregate):
+        self.client = client
+        self.method = method
+        self.key_name = key_name
+        self.kwargs = kwargs
+        self.aggregate = aggregate
+
+    def fetch(self):
+        return self.aggregate(cs_iter(self.client, self.method, self.key_name, **self.kwargs))
+
+
+class Codebook(object):
+    """Interns the values of a column as small integer codes."""
+
+    def __init__(self):
+        self.codes = dict()
+        self.values = []
+
+    def code(self, value):
         try:
-            logger('verb', "Performing listVirtualMachines API call")
-            virtualmachines = cs_list('listVirtualMachines', 'virtualmachine', details='all')
-            logger('verb', "Completed listVirtualMachines API call")
-        except Exception:
-            logger('warn', "status err Unable to connect to CloudStack URL at %s for ListVms" % API_MONITORS)
-
-        virtualMachineZoneRunningCount = 0
-        virtualMachineZoneStoppedCount = 0
-        virtualMachineZoneStartingCount = 0
-        virtualMachineZoneStoppingCount = 0
-        cpu = 0
-        ram = 0
-
-        for virtualmachine in virtualmachines:
-            cpu += virtualmachine['cpunumber']
-            ram += virtualmachine['memory']
-            if virtualmachine['state'] == 'Running':
-                virtualMachineZoneRunningCount = virtualMachineZoneRunningCount + 1
-            elif virtualmachine['state'] == 'Stopped':
-                virtualMachineZoneStoppedCount = virtualMachineZoneStoppedCount + 1
-            elif virtualmachine['state'] == 'Stopping':
-                virtualMachineZoneStartingCount = virtualMachineZoneStartingCount + 1
-            elif virtualmachine['state'] == 'Starting':
-                virtualMachineZoneStoppingCount = virtualMachineZoneStoppingCount + 1
-
-        ram = (ram / 1024)
-        ramavg = (ram / len(virtualmachines))
-        cpuavg = (cpu / len(virtualmachines))
-        stats[metricnameVMZoneRAMavgSize] = ramavg
-        stats[metricnameVMZoneCPUavgSize] = cpuavg
-        stats[metricnameVmZoneTotal] = len(virtualmachines)
-        stats[metricnameVmZoneTotalRunning] = virtualMachineZoneRunningCount
-        stats[metricnameVmZoneTotalStopped] = virtualMachineZoneStoppedCount
-        stats[metricnameVmZoneTotalStopping] = virtualMachineZoneStoppingCount
-        stats[metricnameVmZoneTotalStarting] = virtualMachineZoneStartingCount
-
-        # collect number of root volumes
+            return self.codes[value]
+        except KeyError:
+            self.values.append(value)
+            return self.codes.setdefault(value, len(self.values) - 1)
+
+    def load(self, values):
+        self.values = list(values)
+        self.codes = dict((value, code) for code, value in enumerate(self.values))
+
+
+class ColumnStore(object):
+    """Records kept column by column in typed arrays.
+
+    Every record id owns a slot, its value in a column is column[slot].
+    `columns` are (name, array typecode) pairs, the slots of removed
+    records are reused.
+    """
+
+    def __init__(self, columns):
+        self.names = [name for name, typecode in columns]
+        self.columns = [array.array(typecode) for name, typecode in columns]
+        self.appends = [column.append for column in self.columns]
+        self.slots = dict()
+        self.ids = []
+        self.free = []
+
+    def __len__(self):
+        return len(self.slots)
+
+    def column(self, name):
+        return self.columns[self.names.index(name)]
+
+    def row(self, slot):
+        return tuple(column[slot] for column in self.columns)
+
+    def put(self, recordid, values):
+        slot = self.slots.get(recordid)
+        if slot is None and not self.free:
+            slot = self.slots[recordid] = len(self.ids)
+            self.ids.append(recordid)
+            for append, value in izip(self.appends, values):
+                append(value)
+            return slot
+        if slot is None:
+            slot = self.slots[recordid] = self.free.pop()
+            self.ids[slot] = recordid
+        for column, value in izip(self.columns, values):
+            column[slot] = value
+        return slot
+
+    def remove(self, recordid):
+        slot = self.slots.pop(recordid, None)
+        if slot is not None:
+            self.ids[slot] = None
+            self.free.append(slot)
+        return slot
+
+    def dump(self):
+        # (ids, raw bytes of every column, free slots)
+        return (list(self.ids), [column.tostring() for column in self.columns], list(self.free))
+
+    def load(self, state):
+        ids, columns, free = state
+        for column, data in izip(self.columns, columns):
+            column.fromstring(data)
+            if len(column) != len(ids):
+                raise ValueError("column of %d values for %d records" % (len(column), len(ids)))
+        self.ids = list(ids)
+        self.free = list(free)
+        self.slots = dict((recordid, slot) for slot, recordid in enumerate(self.ids) if recordid is not None)
+
+
+def compact_id(recordid):
+    # a UUID is kept as its 16 bytes instead of a 36 characters string, the
+    # compact ids are compared instead of the strings so case does not matter
+    if len(recordid) == 36:
         try:
-            logger('verb', "Performing listVolumes API call")
-            rootvolumes = cs_list('listVolumes', 'volume', type='ROOT')
-            logger('verb', "Completed listVolumes API call")
-        except Exception:
-            logger('warn', "status err Unable to connect to CloudStack URL at %s for ListVolumes" % API_MONITORS)
+            compact = binascii.unhexlify(recordid.replace('-', ''))
+        except (TypeError, UnicodeEncodeError):
+            pass
+        else:
+            if len(compact) == 16:
+                return compact
+    return unicode(recordid)
 
-        rootvolsize = 0
-        for rootvolume in rootvolumes:
-            rootvolsize += rootvolume['size']
 
-            if rootvolume['vmstate'] == 'Running':
-                # add to a dict to get the Running VMs per hypervisor
-                host = (rootvolume['storage'])
-                if host in hvmrunning:
-                    hvmrunning[host] += 1
-                else:
-                    hvmrunning[host] = 1
-            elif rootvolume['vmstate'] == 'Stopped' and not rootvolume['state'] == 'Allocated':
-                # add to a dict to get the Stopped VMs per hypervisor
-                host = (rootvolume['storage'])
-                if host in hvmstopped:
-                    hvmstopped[host] += 1
-                else:
-                    hvmstopped[host] = 1
-            elif rootvolume['vmstate'] == 'Stopping':
-                # add to a dict to get the Stopping VMs per hypervisor
-                host = (rootvolume['storage'])
-                if host in hvmstopping:
-                    hvmstopping[host] += 1
-                else:
-                    hvmstopping[host] = 1
-            elif rootvolume['vmstate'] == 'Starting':
-                # add to a dict to get the Starting VMs per hypervisor
-                host = (rootvolume['storage'])
-                if host in hvmstarting:
-                    hvmstarting[host] += 1
-                else:
-                    hvmstarting[host] = 1
+def expand_id(compact):
+    if isinstance(compact, unicode):
+        return compact
+    h = compact.encode('hex')
+    return '-'.join((h[:8], h[8:12], h[12:16], h[16:20], h[20:]))
 
-        rootvolsize = (rootvolsize / 1073741824)
-        rootavgsize = rootvolsize / len(rootvolumes)
-        metricnameRootAvgSizeZone = METRIC_DELIM.join(['zonerootdiskavgsize', zone['name'].lower(),  'zonerootdiskavgsize'])
-        stats[metricnameRootAvgSizeZone] = rootavgsize
 
-        # add metric VMs per hypervisor
-        for h in hypervisors:
-            virtualMachineHTotalCount = 0
-            metricnameVmHTotal = METRIC_DELIM.join([h['name'].lower(), h['podname'].lower(), re.sub(r"\s+", '-', h['zonename'].lower()), 'hvmtotal'])
-            metricnameVmHTotalRunning = METRIC_DELIM.join([h['name'].lower(), h['podname'].lower(), re.sub(r"\s+", '-', h['zonename'].lower()), 'hvmtotalrunning'])
-            metricnameVmHTotalStarting = METRIC_DELIM.join([h['name'].lower(), h['podname'].lower(), re.sub(r"\s+", '-', h['zonename'].lower()), 'hvmtotalstarting'])
-            metricnameVmHTotalStopping = METRIC_DELIM.join([h['name'].lower(), h['podname'].lower(), re.sub(r"\s+", '-', h['zonename'].lower()), 'hvmtotalstopping'])
-            metricnameVmHTotalStopped = METRIC_DELIM.join([h['name'].lower(), h['podname'].lower(), re.sub(r"\s+", '-', h['zonename'].lower()), 'hvmtotalstopped'])
-
-            hname = h['name'].lower()
-            if hname in hvmrunning:
-                virtualMachineHTotalCount = virtualMachineHTotalCount + hvmrunning[hname]
-                stats[metricnameVmHTotalRunning] = hvmrunning[hname]
-            else:
-                stats[metricnameVmHTotalRunning] = 0
-            if hname in hvmstarting:
-                virtualMachineHTotalCount = virtualMachineHTotalCount + hvmstarting[hname]
-                stats[metricnameVmHTotalStarting] = hvmstarting[hname]
-            else:
-                stats[metricnameVmHTotalStarting] = 0
-            if hname in hvmstopping:
-                virtualMachineHTotalCount = virtualMachineHTotalCount + hvmstopping[hname]
-                stats[metricnameVmHTotalStopping] = hvmstopping[hname]
-            else:
-                stats[metricnameVmHTotalStopping] = 0
-            if hname in hvmstopped:
-                virtualMachineHTotalCount = virtualMachineHTotalCount + hvmstopped[hname]
-                stats[metricnameVmHTotalStopped] = hvmstopped[hname]
+class VmInventory(object):
+    """VM and root volume inventory kept current from listEvents.
+
+    The inventory is seeded by a full listing. After that only the VMs and
+    root volumes named by the VM.* and VOLUME.* events since the previous
+    refresh are listed again, and their contribution to the per zone and
+    per host counters is replaced. A full listing runs every
+    `resync_interval` seconds to correct any drift, and whenever an event
+    does not carry a resourceid (CloudStack before 4.17).
+
+    Only the fields the counters need are kept, in typed array columns:
+    states, zones, hosts and storages as interned codes, ids as 16 bytes.
+    A VM keeps the storage of its root volume, where it is counted while
+    it has no host.
+    A full listing fills the columns as the pages arrive, then computes
+    the counters in a single grouped pass over them.
+    """
+
+    method = 'listEvents'
+
+    def __init__(self, client, resync_interval, top_accounts=TOP_ACCOUNTS):
+        self.client = client
+        self.resync_interval = resync_interval
+        self.top_accounts = top_accounts
+        self.lastsync = 0
+        self.since = None
+        # with a warm-start cache, the dump() of the latest fetch
+        self.persist = False
+        self.saved = None
+        self.reset()
+
+    def reset(self):
+        self.states = Codebook()
+        self.zones = Codebook()
+        self.hosts = Codebook()
+        self.storages = Codebook()
+        self.accounts = Codebook()
+        self.vms = ColumnStore([('zone', 'H'), ('state', 'B'), ('cpu', 'H'), ('ram', 'I'), ('host', 'I'), ('account', 'I'), ('storage', 'I')])
+        self.volumes = ColumnStore([('zone', 'H'), ('size', 'L'), ('storage', 'I'), ('vm', 'l')])
+        self.zonevms = dict()
+        self.hostvms = dict()
+        self.storagevms = dict()
+        self.zonevolumes = dict()
+        # running VMs, vCPUs and RAM per account code
+        self.accounttotals = dict()
+
+    def fetch(self):
+        changed = True
+        if self.since is None or time.time() - self.lastsync >= self.resync_interval:
+            self.resync()
+        else:
+            changed = self.apply_events()
+        # a new dump only when the columns changed, an inventory resuming
+        # from an older position in the events lists the same VMs again
+        if self.persist and changed:
+            self.saved = self.dump()
+        return copy.deepcopy((self.zonevms, self.zonevolumes, self.storagevms, self.hostvms)) + (self.heavy_hitters(),)
+
+    def heavy_hitters(self):
+        # accounts with the most running VMs, vCPUs and RAM, from the totals
+        # kept per account as the VMs change
+        if not self.top_accounts:
+            return None
+        accounts = self.accounts.values
+        totals = self.accounttotals
+        return dict((name, [(accounts[code], counts[index])
+                            for code, counts in heapq.nlargest(self.top_accounts, totals.iteritems(), key=lambda item: item[1][index])])
+                    for index, name in enumerate(('total', 'cpu', 'ram')))
+
+    def count_account(self, account, cpu, ram, sign, n=1):
+        totals = self.accounttotals.get(account)
+        if totals is None:
+            totals = self.accounttotals[account] = [0, 0, 0]
+        totals[0] += sign * n
+        totals[1] += sign * cpu
+        totals[2] += sign * ram
+        if not totals[0]:
+            del self.accounttotals[account]
+
+    def dump(self):
+        # the columns and the position in the events, enough to count again
+        # and resume from listEvents without a full listing
+        return {
+            'since': self.since,
+            'lastsync': self.lastsync,
+            'codebooks': [list(codebook.values) for codebook in (self.states, self.zones, self.hosts, self.storages, self.accounts)],
+            'vms': self.vms.dump(),
+            'volumes': self.volumes.dump(),
+        }
+
+    def restore(self, state):
+        self.reset()
+        for codebook, values in izip((self.states, self.zones, self.hosts, self.storages, self.accounts), state['codebooks']):
+            codebook.load(values)
+        self.vms.load(state['vms'])
+        self.volumes.load(state['volumes'])
+        self.group_by()
+        self.since = state['since']
+        self.lastsync = state['lastsync']
+        self.saved = state
+
+    def resync(self):
+        started = time.time()
+        self.since = None
+        response = self.client.call('listEvents', listall='true', page=1, pagesize=1)
+        events = response.get('event', [])
+        since = event_time(events[0]['created']) if events else '1970-01-01 00:00:00'
+
+        self.reset()
+        for virtualmachine in cs_iter(self.client, 'listVirtualMachines', 'virtualmachine', **VM_LIST_ARGS):
+            self.set_vm(virtualmachine['id'], virtualmachine, count=False)
+        for rootvolume in cs_iter(self.client, 'listVolumes', 'volume', **ROOTVOLUME_LIST_ARGS):
+            self.set_volume(rootvolume['id'], rootvolume, count=False)
+        self.group_by()
+
+        self.since = since
+        self.lastsync = started
+        logger('verb', "inventory resynced: %s VMs, %s root volumes" % (len(self.vms), len(self.volumes)))
+
+    def group_by(self):
+        # count the VMs per (zone, host or storage, state) and the volumes
+        # per zone in one pass over the columns, then add every group to the
+        # counters at once
+        nohost = self.hosts.code(None)
+        nostorage = self.storages.code(None)
+        running = self.states.code('Running')
+        vmgroups = dict()
+        accountgroups = dict()
+        for vmid, zone, state, cpu, ram, host, account, storage in izip(self.vms.ids, *self.vms.columns):
+            if vmid is None:
+                continue
+            if state == running:
+                group = accountgroups.get(account)
+                if group is None:
+                    group = accountgroups[account] = [0, 0, 0]
+                group[0] += 1
+                group[1] += cpu
+                group[2] += ram
+            if host != nohost:
+                storage = nostorage
+            group = vmgroups.get((zone, host, storage, state))
+            if group is None:
+                group = vmgroups[zone, host, storage, state] = [0, 0, 0]
+            group[0] += 1
+            group[1] += cpu
+            group[2] += ram
+        for (zone, host, storage, state), (count, cpu, ram) in vmgroups.items():
+            vm = (self.zones.values[zone], self.states.values[state], cpu, ram, self.hosts.values[host], self.storages.values[storage])
+            count_vm(self.zonevms, self.hostvms, self.storagevms, vm, 1, count)
+        for account, (count, cpu, ram) in accountgroups.items():
+            self.count_account(account, cpu, ram, 1, count)
+
+        volumegroups = dict()
+        for volumeid, zone, size, storage, vm in izip(self.volumes.ids, *self.volumes.columns):
+            if volumeid is None:
+                continue
+            group = volumegroups.get(zone)
+            if group is None:
+                group = volumegroups[zone] = [0, 0]
+            group[0] += 1
+            group[1] += size
+        for zone, (count, size) in volumegroups.items():
+            count_rootvolume(self.zonevolumes, (self.zones.values[zone], size), 1, count)
+
+    def apply_events(self):
+        since = self.since
+        changedvms = set()
+        changedvolumes = set()
+        for event in cs_iter(self.client, 'listEvents', 'event', startdate=self.since):
+            if not event['type'].startswith(('VM.', 'VOLUME.')):
+                continue
+            if not event.get('resourceid'):
+                logger('verb', "%s event without resourceid, resyncing the inventory" % event['type'])
+                self.resync()
+                return True
+            if event['type'].startswith('VM.'):
+                changedvms.add(event['resourceid'])
             else:
-                stats[metricnameVmHTotalStopped] = 0
+                changedvolumes.add(event['resourceid'])
+            since = max(since, event_time(event['created']))
+
+        # the root volume carries the state of its VM
+        linked = set()
+        if changedvms:
+            vmslots = set(self.vms.slots.get(compact_id(vmid)) for vmid in changedvms)
+            for volumeid, vm in izip(self.volumes.ids, self.volumes.column('vm')):
+                if volumeid is not None and vm in vmslots:
+                    changedvolumes.add(expand_id(volumeid))
+                    linked.add(vm)
+        unlinked = [vmid for vmid in changedvms if self.vms.slots.get(compact_id(vmid)) not in linked]
+
+        self.reload('listVirtualMachines', 'virtualmachine', changedvms, self.set_vm, VM_LIST_ARGS)
+        self.reload('listVolumes', 'volume', changedvolumes, self.set_volume, ROOTVOLUME_LIST_ARGS)
+        # the root volume created with a VM has no VOLUME.* event of its own,
+        # it is listed by VM for the new VMs and the ones without one
+        for vmid in unlinked:
+            if compact_id(vmid) in self.vms.slots:
+                for rootvolume in cs_iter(self.client, 'listVolumes', 'volume', virtualmachineid=vmid, **ROOTVOLUME_LIST_ARGS):
+                    self.set_volume(rootvolume['id'], rootvolume)
+        self.since = since
+        logger('verb', "inventory updated: %s VMs, %s root volumes changed" % (len(changedvms), len(changedvolumes)))
+        return bool(changedvms or changedvolumes)
+
+    def reload(self, method, key_name, ids, update, kwargs):
+        # list the given ids again, the ones not returned anymore are gone
+        ids = list(ids)
+        for start in range(0, len(ids), 100):
+            chunk = ids[start:start + 100]
+            found = set()
+            for record in cs_iter(self.client, method, key_name, ids=','.join(chunk), **kwargs):
+                found.add(compact_id(record['id']))
+                update(record['id'], record)
+            for missing in chunk:
+                if compact_id(missing) not in found:
+                    update(missing, None)
+
+    def vm_record(self, slot):
+        zone, state, cpu, ram, host, account, storage = self.vms.row(slot)
+        return (self.zones.values[zone], self.states.values[state], cpu, ram, self.hosts.values[host], self.storages.values[storage])
+
+    def volume_record(self, slot):
+        zone, size, storage, vm = self.volumes.row(slot)
+        return (self.zones.values[zone], size)
 
-            stats[metricnameVmHTotal] = virtualMachineHTotalCount
+    def set_vm(self, vmid, virtualmachine, count=True):
+        vmid = compact_id(vmid)
+        slot = self.vms.slots.get(vmid)
+        if count and slot is not None:
+            count_vm(self.zonevms, self.hostvms, self.storagevms, self.vm_record(slot), -1)
+            self.count_running(slot, -1)
+        if virtualmachine is None:
+            self.vms.remove(vmid)
+            return
+        # the storage comes from the root volume, which may be listed later
+        storage = self.vms.column('storage')[slot] if slot is not None else self.storages.code(None)
+        slot = self.vms.put(vmid, (self.zones.code(virtualmachine['zoneid']), self.states.code(virtualmachine['state']),
+                                   virtualmachine['cpunumber'], virtualmachine['memory'], self.hosts.code(virtualmachine.get('hostid')),
+                                   self.accounts.code((virtualmachine.get('domainid'), virtualmachine.get('domain'), virtualmachine.get('account'))),
+                                   storage))
+        if count:
+            count_vm(self.zonevms, self.hostvms, self.storagevms, self.vm_record(slot), 1)
+            self.count_running(slot, 1)
+
+    def count_running(self, slot, sign):
+        # the account totals only cover the running VMs
+        zone, state, cpu, ram, host, account, storage = self.vms.row(slot)
+        if self.states.values[state] == 'Running':
+            self.count_account(account, cpu, ram, sign)
+
+    def place_vm(self, slot, storage, count):
+        # move a VM to the storage of its root volume
+        column = self.vms.column('storage')
+        if column[slot] == storage:
+            return
+        if count:
+            count_vm(self.zonevms, self.hostvms, self.storagevms, self.vm_record(slot), -1)
+        column[slot] = storage
+        if count:
+            count_vm(self.zonevms, self.hostvms, self.storagevms, self.vm_record(slot), 1)
+
+    def set_volume(self, volumeid, rootvolume, count=True):
+        volumeid = compact_id(volumeid)
+        previous = self.volumes.slots.get(volumeid)
+        if previous is not None:
+            if count:
+                count_rootvolume(self.zonevolumes, self.volume_record(previous), -1)
+            vm = self.volumes.column('vm')[previous]
+            if vm >= 0 and self.vms.ids[vm] is not None:
+                self.place_vm(vm, self.storages.code(None), count)
+        if rootvolume is None:
+            self.volumes.remove(volumeid)
+            return
+        vmid = rootvolume.get('virtualmachineid')
+        vm = self.vms.slots.get(compact_id(vmid), -1) if vmid else -1
+        storage = self.storages.code(placement_storage(rootvolume))
+        slot = self.volumes.put(volumeid, (self.zones.code(rootvolume['zoneid']), rootvolume['size'], storage, vm))
+        if vm >= 0:
+            self.place_vm(vm, storage, count)
+        if count:
+            count_rootvolume(self.zonevolumes, self.volume_record(slot), 1)
+
+
+class QuantileSketch(object):
+    """Streaming quantiles of positive values with a bounded relative error.
+
+    Values are counted in logarithmically sized buckets (as in DDSketch):
+    a quantile is within `accuracy` of the exact one whatever the number of
+    values, and at most `max_buckets` buckets are kept, the lowest ones
+    being merged together beyond that.
+    """
+
+    def __init__(self, accuracy=0.01, max_buckets=1024):
+        self.accuracy = accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.loggamma = math.log(self.gamma)
+        self.buckets = dict()
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value, n=1):
+        self.count += n
+        if value <= 0:
+            self.zeros += n
+            return
+        self._count(int(math.ceil(math.log(value) / self.loggamma)), n)
+
+    def _count(self, index, n):
+        self.buckets[index] = self.buckets.get(index, 0) + n
+        if len(self.buckets) > self.max_buckets:
+            lowest, nextlowest = sorted(self.buckets)[:2]
+            self.buckets[nextlowest] += self.buckets.pop(lowest)
+
+    def merge(self, other):
+        # both sketches must have the same accuracy
+        self.zeros += other.zeros
+        self.count += other.count
+        for index, n in other.buckets.items():
+            self._count(index, n)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+class AsyncJobs(object):
+    """Unfinished async jobs per command and the durations of the finished ones.
+
+    The durations feed a quantile sketch as the jobs finish, the raw job
+    history is never kept. The percentiles cover the jobs finished during
+    the last one or two `window`, the sketch being replaced every window.
+    Only the jobs created since the oldest unfinished one are listed
+    again, a finished job is counted when it was unfinished in the
+    previous listing or created after it. The first listing only sets
+    the mark, the jobs it finds finished are not counted.
+    """
+
+    method = 'listAsyncJobs'
+
+    def __init__(self, client, window):
+        self.client = client
+        self.window = window
+        self.since = None
+        self.latest = None
+        self.pending = set()
+        self.commands = set()
+        self.rotated = time.time()
+        self.previous = QuantileSketch()
+        self.current = QuantileSketch()
+
+    def fetch(self):
+        if time.time() - self.rotated >= self.window:
+            self.previous, self.current = self.current, QuantileSketch()
+            self.rotated = time.time()
+
+        kwargs = dict()
+        if self.since:
+            kwargs['startdate'] = self.since
+        unfinished = dict()
+        pending = set()
+        oldest = latest = None
+        for job in cs_iter(self.client, 'listAsyncJobs', 'asyncjobs', **kwargs):
+            created = job.get('created')
+            if created and (latest is None or created > latest):
+                latest = created
+            if job.get('jobstatus') == 0:
+                command = job.get('cmd', '').rsplit('.', 1)[-1]
+                if command.endswith('Cmd'):
+                    command = command[:-3]
+                unfinished[command] = unfinished.get(command, 0) + 1
+                pending.add(job['jobid'])
+                if created and (oldest is None or created < oldest):
+                    oldest = created
+                continue
+            if not created or not job.get('completed'):
+                continue
+            if job['jobid'] in self.pending or (self.latest is not None and created > self.latest):
+                self.current.add(api_timestamp(job['completed']) - api_timestamp(created))
+        self.pending = pending
+        # '' once listed without any job, all the later ones are new
+        self.latest = max(latest or '', self.latest or '')
+        # listAsyncJobs takes its startdate as the yyyy-MM-dd'T'HH:mm:ssZ
+        # dates it returns, unlike listEvents
+        if oldest or self.latest:
+            self.since = oldest or self.latest
+
+        # a command keeps being reported, as 0, once it has no unfinished job
+        self.commands.update(unfinished)
+        sketch = QuantileSketch()
+        sketch.merge(self.previous)
+        sketch.merge(self.current)
+        return {
+            'unfinished': dict((command, unfinished.get(command, 0)) for command in self.commands),
+            'durations': dict((q, sketch.quantile(q / 100)) for q in (50, 95, 99)),
+        }
+
+
+# queries of the "database" source, they return the rows the API path would
+# reduce: user VMs and the root volumes listVolumes shows (not the ones of
+# system VMs), the custom offerings keep cpu and memory in user_vm_details
+QUERY_VMS = """SELECT dc.uuid, h.uuid, CASE WHEN h.uuid IS NULL THEN sp.name END, vm.state, COUNT(*),
+  SUM(CAST(COALESCE(so.cpu, cpu.value) AS UNSIGNED)), SUM(CAST(COALESCE(so.ram_size, ram.value) AS UNSIGNED))
+FROM vm_instance vm
+JOIN data_center dc ON dc.id = vm.data_center_id
+LEFT JOIN host h ON h.id = vm.host_id
+LEFT JOIN volumes v ON v.instance_id = vm.id AND v.volume_type = 'ROOT' AND v.removed IS NULL AND v.state != 'Allocated'
+LEFT JOIN storage_pool sp ON sp.id = v.pool_id
+LEFT JOIN service_offering so ON so.id = vm.service_offering_id
+LEFT JOIN user_vm_details cpu ON cpu.vm_id = vm.id AND cpu.name = 'cpuNumber'
+LEFT JOIN user_vm_details ram ON ram.vm_id = vm.id AND ram.name = 'memory'
+WHERE vm.type = 'User' AND vm.removed IS NULL
+GROUP BY dc.uuid, h.uuid, CASE WHEN h.uuid IS NULL THEN sp.name END, vm.state"""
+
+QUERY_ROOTVOLUMES = """SELECT dc.uuid, COUNT(*), SUM(v.size)
+FROM volumes v
+JOIN data_center dc ON dc.id = v.data_center_id
+LEFT JOIN vm_instance vm ON vm.id = v.instance_id
+WHERE v.volume_type = 'ROOT' AND v.removed IS NULL AND (vm.type IS NULL OR vm.type = 'User')
+GROUP BY dc.uuid"""
+
+# accounts with the most running user VMs, vCPUs or RAM, ordered by the
+# given column of the result
+QUERY_TOP_ACCOUNTS = """SELECT d.uuid, d.name, a.account_name, COUNT(*),
+  SUM(CAST(COALESCE(so.cpu, cpu.value) AS UNSIGNED)), SUM(CAST(COALESCE(so.ram_size, ram.value) AS UNSIGNED))
+FROM vm_instance vm
+JOIN account a ON a.id = vm.account_id
+JOIN domain d ON d.id = a.domain_id
+LEFT JOIN service_offering so ON so.id = vm.service_offering_id
+LEFT JOIN user_vm_details cpu ON cpu.vm_id = vm.id AND cpu.name = 'cpuNumber'
+LEFT JOIN user_vm_details ram ON ram.vm_id = vm.id AND ram.name = 'memory'
+WHERE vm.type = 'User' AND vm.removed IS NULL AND vm.state = 'Running'
+GROUP BY a.domain_id, a.account_name
+ORDER BY %d DESC
+LIMIT %d"""
+
+# listAccounts leaves out the system account (id 1) and the project accounts (type 5)
+QUERY_ACCOUNTS = """SELECT state, COUNT(*) FROM account
+WHERE removed IS NULL AND id != 1 AND type != 5
+GROUP BY state"""
+
+
+class DatabaseInventory(object):
+    """The VM and root volume counters of VmInventory, aggregated by the cloud database."""
+
+    method = 'database inventory'
+
+    def __init__(self, db, top_accounts=TOP_ACCOUNTS):
+        self.db = db
+        self.top_accounts = top_accounts
+
+    def fetch(self):
+        zonevms = dict()
+        hostvms = dict()
+        storagevms = dict()
+        for zoneid, hostid, storage, state, count, cpu, ram in self.db.query(QUERY_VMS):
+            count_vm(zonevms, hostvms, storagevms, (zoneid, state, int(cpu or 0), int(ram or 0), hostid, storage), 1, int(count))
+        zonevolumes = dict()
+        for zoneid, count, size in self.db.query(QUERY_ROOTVOLUMES):
+            count_rootvolume(zonevolumes, (zoneid, int(size or 0)), 1, int(count))
+        topaccounts = None
+        if self.top_accounts:
+            topaccounts = dict()
+            for name, column in (('total', 4), ('cpu', 5), ('ram', 6)):
+                rows = self.db.query(QUERY_TOP_ACCOUNTS % (column, self.top_accounts))
+                topaccounts[name] = [(tuple(row[:3]), int(row[column - 1] or 0)) for row in rows]
+        return zonevms, zonevolumes, storagevms, hostvms, topaccounts
+
+
+class DatabaseAccounts(object):
+    """The aggregate_accounts counters, aggregated by the cloud database."""
+
+    method = 'database accounts'
+
+    def __init__(self, db):
+        self.db = db
+
+    def fetch(self):
+        counters = {'total': 0, 'enabled': 0, 'disabled': 0}
+        for state, count in self.db.query(QUERY_ACCOUNTS):
+            counters['total'] += int(count)
+            if state in counters:
+                counters[state] += int(count)
+        return counters
+
+
+def new_resources(client, database, resync_interval, top_accounts=TOP_ACCOUNTS):
+    """Resources refreshed by the collector of an endpoint: name -> resource with a fetch() method.
+
+    The list calls consume their items as the pages arrive, the large
+    inventories are reduced to counters without ever being held in memory
+    as a whole. With a `database`, the VM, root volume and account figures
+    are aggregated by the cloud database instead.
+    """
+    resources = {
+        'hosts': ListResource(client, 'listHosts', 'host', {'type': 'Routing', 'resourcestate': 'Enabled', 'state': 'Up'}, list),
+        'systemvms': ListResource(client, 'listSystemVms', 'systemvm', {'systemvmtype': 'consoleproxy'}, list),
+        'zones': ListResource(client, 'listZones', 'zone', {'showcapacities': 'true'}, list),
+        'capacity': ListResource(client, 'listCapacity', 'capacity', {}, list),
+    }
+    if database:
+        resources['inventory'] = DatabaseInventory(database, top_accounts)
+        resources['accounts'] = DatabaseAccounts(database)
+    else:
+        resources['inventory'] = VmInventory(client, resync_interval, top_accounts)
+        resources['accounts'] = ListResource(client, 'listAccounts', 'account', {}, aggregate_accounts)
+    resources['asyncjobs'] = AsyncJobs(client, ASYNC_JOBS_WINDOW)
+    return resources
+
+
+# config keys of the per-resource refresh intervals
+RESOURCE_INTERVAL_KEYS = {
+    'HostsInterval': 'hosts',
+    'SystemVmsInterval': 'systemvms',
+    'ZonesInterval': 'zones',
+    'VirtualMachinesInterval': 'inventory',
+    'AccountsInterval': 'accounts',
+    'CapacityInterval': 'capacity',
+    'AsyncJobsInterval': 'asyncjobs',
+}
+
+
+def fetch_resource(endpoint, name, resource, results):
+    started = time.time()
+    try:
+        logger('verb', "Performing %s API call" % resource.method)
+        results[name] = resource.fetch()
+        logger('verb', "Completed %s API call" % resource.method)
+    except Exception as e:
+        logger('warn', "status err Unable to connect to CloudStack URL at %s for %s: %s" % (endpoint.api, resource.method, e))
+    endpoint.stats.duration('refresh-%s' % name, time.time() - started)
+
+
+def fetch_resources(endpoint, timeout):
+    # run every list call in its own thread, a failed or late call is left
+    # out of the results without holding up the others
+    resources = endpoint.resources
+    results = dict()
+    threads = dict()
+
+    for name, resource in resources.items():
+        threads[name] = threading.Thread(target=fetch_resource, args=(endpoint, name, resource, results), name='%s-%s' % (NAME, resource.method))
+        threads[name].daemon = True
+        threads[name].start()
+
+    deadline = time.time() + timeout
+    for name, thread in threads.items():
+        thread.join(max(0, deadline - time.time()))
+        if thread.is_alive():
+            logger('warn', "%s API call did not complete within %ss" % (resources[name].method, timeout))
+
+    return dict((name, results[name]) for name, thread in threads.items() if not thread.is_alive() and name in results)
+
+
+class WorkerPool(object):
+    """Threads running the resource refreshes of all the endpoints."""
+
+    def __init__(self, size):
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for index in range(size):
+            thread = threading.Thread(target=self._work, name='%s-worker-%d' % (NAME, index))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            func, args = task
+            try:
+                func(*args)
+            except Exception as e:
+                logger('err', "worker task failed: %s" % e)
+
+    def submit(self, func, *args):
+        self.tasks.put((func, args))
+
+    def close(self):
+        # idle workers exit, the ones stuck in a call are daemon threads
+        for thread in self.threads:
+            self.tasks.put(None)
+
+
+class ResourceScheduler(object):
+    """Refreshes every resource of an endpoint on its own interval and caches its last result.
+
+    The refreshes run on the shared `workers`, at most `endpoint.workers`
+    at a time, so a slow inventory listing never delays the cheap
+    resources and a stalled endpoint never holds more than its own share
+    of the pool. `wakeup` is set whenever a refresh ends and `dirty` tells
+    whether a new result landed in the cache since the last call to
+    results(). A result is cached with the time its refresh started and
+    is left out of the results once older than MAX_SNAPSHOT_AGE, so a
+    resource failing to refresh is not served from the cache forever,
+    unless a refresh of the resource is still running within its timeout.
+    """
+
+    def __init__(self, endpoint, workers):
+        self.endpoint = endpoint
+        self.workers = workers
+        self.resources = endpoint.resources
+        self.intervals = endpoint.intervals
+        self.timeout = endpoint.fetch_timeout
+        self.cache = dict()
+        self.started = dict()
+        self.running = set()
+        self.dirty = False
+        self.attempted = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def _refresh(self, name, started):
+        results = dict()
+        try:
+            fetch_resource(self.endpoint, name, self.resources[name], results)
+            if name not in results:
+                return
+            if time.time() - started > self.timeout:
+                logger('warn', "%s API call did not complete within %ss" % (self.resources[name].method, self.timeout))
+                return
+            with self.lock:
+                self.cache[name] = (started, results[name])
+                self.dirty = True
+        finally:
+            with self.lock:
+                self.running.discard(name)
+                self.attempted.add(name)
+            self.wakeup.set()
+
+    def start_due(self, now):
+        # the most overdue resources go first when the budget is short
+        due = sorted((self.started.get(name, 0) + self.intervals[name], name) for name in self.resources)
+        for deadline, name in due:
+            with self.lock:
+                if len(self.running) >= self.endpoint.workers:
+                    return
+                if name in self.running or deadline > now:
+                    continue
+                self.running.add(name)
+            self.started[name] = now
+            self.workers.submit(self._refresh, name, now)
+
+    def next_due(self, now):
+        # seconds until an idle resource is due, running ones wake us up through `wakeup`
+        with self.lock:
+            if len(self.running) >= self.endpoint.workers:
+                return max(self.intervals.values())
+            due = [self.started.get(name, 0) + self.intervals[name] - now for name in self.resources if name not in self.running]
+        return max(0, min(due)) if due else max(self.intervals.values())
+
+    def warm(self):
+        # every resource had its first refresh, successful or not
+        return len(self.attempted) == len(self.resources)
+
+    def results(self):
+        now = time.time()
+        with self.lock:
+            self.dirty = False
+            for name, (fetched, result) in self.cache.items():
+                if name in self.running and now - self.started[name] <= self.timeout:
+                    continue
+                if now - fetched > MAX_SNAPSHOT_AGE:
+                    logger('warn', "%s: last %s result of %s is %ds old, leaving it out" % (NAME, self.resources[name].method, self.endpoint.api, now - fetched))
+                    del self.cache[name]
+            return dict((name, result) for name, (fetched, result) in self.cache.items())
+
+
+def get_stats(endpoint, resources=None):
+    stats = dict()
+    metrics = endpoint.metrics
+
+    logger('verb', "get_stats calls API %s KEY %s SECRET %s" % (endpoint.api, endpoint.apikey, endpoint.secret))
+
+    if resources is None:
+        resources = fetch_resources(endpoint, endpoint.fetch_timeout)
+    hypervisors = resources.get('hosts', [])
+    zones = resources.get('zones', [])
+
+    for h in hypervisors:
+        hostpath = metrics.host_path(h)
+        metricnameMemUsed = metrics.metric(hostpath, 'memoryused')
+        metricnameMemTotal = metrics.metric(hostpath, 'memorytotal')
+        metricnameMemAlloc = metrics.metric(hostpath, 'memoryallocated')
+        metricnameCpuAlloc = metrics.metric(hostpath, 'cpuallocated')
+        # metricnameDiskAlloc = metrics.metric(hostpath, 'disksizeallocated')
+        # metricnameDiskTotal = metrics.metric(hostpath, 'disksizetotal')
+        try:
+            stats[metricnameMemUsed] = h['memoryused']
+            stats[metricnameMemTotal] = h['memorytotal']
+            stats[metricnameMemAlloc] = h['memoryallocated']
+            cpuallocated = h['cpuallocated'].replace("%", "")
+            stats[metricnameCpuAlloc] = cpuallocated
+            logger('verb', "readings :  %s memory used %s " % (h['name'], h['memoryused']))
+
+        except (TypeError, ValueError):
+            pass
+
+    # collect number of active console sessions
+    for systemvm in resources.get('systemvms', []):
+        metricnameSessions = metrics.metric(('activeviewersessions', metrics.lower(systemvm['zonename']), metrics.lower(systemvm['name'])), 'activeviewersessions')
+        if 'activeviewersessions' in systemvm:
+            stats[metricnameSessions] = systemvm['activeviewersessions']
+
+    # collect number of zones, available public ips and VMs
+    # virtual machines and root volumes are listed once and grouped per zone
+    zonevms, zonevolumes, storagevms, hostvms, topaccounts = resources.get('inventory', (None, None, None, None, None))
+
+    zonehosts = dict()
+    for h in hypervisors:
+        zonehosts[h['zoneid']] = zonehosts.get(h['zoneid'], 0) + 1
+
+    for zone in zones:
+        zonename = metrics.lower(zone['name'])
+        metricnameIpAllocated = metrics.metric(('zonepublicipallocated', zonename), 'zonepublicipallocated')
+        metricnameIpTotal = metrics.metric(('zonepubliciptotal', zonename), 'zonepubliciptotal')
+        metricnameIpAllocatedPercent = metrics.metric(('zonepublicippercent', zonename), 'zonepublicippercent')
+        metricnameVmZoneTotalRunning = metrics.metric(('zonevmtotalrunning', zonename), 'zonevmtotalrunning')
+        metricnameVmZoneTotalStopped = metrics.metric(('zonevmtotalstopped', zonename), 'zonevmtotalstopped')
+        metricnameVmZoneTotalStopping = metrics.metric(('zonevmtotalstopping', zonename), 'zonevmtotalstopping')
+        metricnameVmZoneTotalStarting = metrics.metric(('zonevmtotalstarting', zonename), 'zonevmtotalstarting')
+        metricnameVmZoneTotal = metrics.metric(('zonevmtotal', zonename), 'zonevmtotal')
+        metricnameVmZoneCpu = metrics.metric(('zonevmcpu', zonename), 'zonevmcpu')
+        metricnameVmZoneRam = metrics.metric(('zonevmram', zonename), 'zonevmram')
+        metricnameHostZoneTotal = metrics.metric(('zonehosttotal', zonename), 'zonehosttotal')
+        metricnameVMZoneRAMavgSize = metrics.metric(('zonevmramavgsize', zonename), 'zonevmramavgsize')
+        metricnameVMZoneCPUavgSize = metrics.metric(('zonevmcpuavgsize', zonename), 'zonevmcpuavgsize')
+        metricnameRootAvgSizeZone = metrics.metric(('zonerootdiskavgsize', zonename), 'zonerootdiskavgsize')
+
+        if zonevms is not None:
+            vms = zonevms.get(zone['id'], new_vm_counters())
+            if vms['total']:
+                stats[metricnameVMZoneRAMavgSize] = (vms['ram'] / 1024) / vms['total']
+                stats[metricnameVMZoneCPUavgSize] = vms['cpu'] / vms['total']
+            stats[metricnameVmZoneTotal] = vms['total']
+            stats[metricnameVmZoneCpu] = vms['cpu']
+            stats[metricnameVmZoneRam] = vms['ram'] * 1048576
+            stats[metricnameVmZoneTotalRunning] = vms['Running']
+            stats[metricnameVmZoneTotalStopped] = vms['Stopped']
+            stats[metricnameVmZoneTotalStopping] = vms['Stopping']
+            stats[metricnameVmZoneTotalStarting] = vms['Starting']
+
+        if zonevolumes is not None:
+            volumes = zonevolumes.get(zone['id'])
+            if volumes and volumes['count']:
+                stats[metricnameRootAvgSizeZone] = (volumes['size'] / 1073741824) / volumes['count']
+
+        stats[metricnameHostZoneTotal] = zonehosts.get(zone['id'], 0)
 
         for capacity in zone['capacity']:
             if capacity['type'] == 8:
@@ -291,153 +1477,557 @@ def get_stats():
                 stats[metricnameIpAllocated] = capacity['capacityused']
                 stats[metricnameIpAllocatedPercent] = capacity['percentused']
 
-    stats[metricnameZonesCount] = len(zones)
-    stats[metricnameHostZoneTotal] = len(hypervisors)
+    # add metric VMs per hypervisor, a VM is counted on its host or, without
+    # one, on the hypervisor its root volume is stored on
+    if hostvms is not None:
+        hostcounters = dict()
+        for h in hypervisors:
+            hostpath = metrics.host_path(h)
+            metricnameVmHTotal = metrics.metric(hostpath, 'hvmtotal')
+            metricnameVmHTotalRunning = metrics.metric(hostpath, 'hvmtotalrunning')
+            metricnameVmHTotalStarting = metrics.metric(hostpath, 'hvmtotalstarting')
+            metricnameVmHTotalStopping = metrics.metric(hostpath, 'hvmtotalstopping')
+            metricnameVmHTotalStopped = metrics.metric(hostpath, 'hvmtotalstopped')
 
-    # collect accounts
-    try:
-        logger('verb', "Performing listAccounts API call")
-        accounts = cs_list('listAccounts', 'account')
-        logger('verb', "Completed listAccounts API call")
-    except Exception:
-        logger('err', "status err Unable to connect to CloudStack URL at %s for ListAccounts")
-
-    metricnameAccountsTotal = METRIC_DELIM.join(['accounts',  'accountscount'])
-    metricnameAccountsTotalEnabled = METRIC_DELIM.join(['accounts',  'accountenabled'])
-    metricnameAccountsTotalDisabled = METRIC_DELIM.join(['accounts',  'accountdisabled'])
-    accountsEnabledCount = 0
-    accountsDisabledCount = 0
+            metricnameVmHCpu = metrics.metric(hostpath, 'hvmcpu')
+            metricnameVmHRam = metrics.metric(hostpath, 'hvmram')
 
-    for account in accounts:
-        if account['state'] == 'enabled':
-            accountsEnabledCount = accountsEnabledCount + 1
-        elif account['state'] == 'disabled':
-            accountsDisabledCount = accountsDisabledCount + 1
+            hvms = hostcounters[h['id']] = new_vm_counters()
+            for placed in (hostvms.get(h['id']), storagevms.get(hostpath[0])):
+                if placed is not None:
+                    for counter in hvms:
+                        hvms[counter] += placed[counter]
+            stats[metricnameVmHTotalRunning] = hvms['Running']
+            stats[metricnameVmHTotalStarting] = hvms['Starting']
+            stats[metricnameVmHTotalStopping] = hvms['Stopping']
+            stats[metricnameVmHTotalStopped] = hvms['Stopped']
+            stats[metricnameVmHTotal] = hvms['total']
+            stats[metricnameVmHCpu] = hvms['cpu']
+            stats[metricnameVmHRam] = hvms['ram'] * 1048576
 
-    stats[metricnameAccountsTotal] = len(accounts)
-    stats[metricnameAccountsTotalEnabled] = accountsEnabledCount
-    stats[metricnameAccountsTotalDisabled] = accountsDisabledCount
+        # roll the same counters up to the clusters and pods, the zone
+        # figures are the zonevm* metrics, which include the VMs of no host
+        rollups = rollup_hosts(hypervisors, hostcounters)
+        for h, counters in rollups['cluster'].values():
+            clusterpath = (metrics.lower(h['clustername']), metrics.lower(h['podname']), metrics.slug(h['zonename']))
+            stats[metrics.metric(clusterpath, 'clustervmtotalrunning')] = counters['Running']
+            stats[metrics.metric(clusterpath, 'clustervmtotalstarting')] = counters['Starting']
+            stats[metrics.metric(clusterpath, 'clustervmtotalstopping')] = counters['Stopping']
+            stats[metrics.metric(clusterpath, 'clustervmtotalstopped')] = counters['Stopped']
+            stats[metrics.metric(clusterpath, 'clustervmtotal')] = counters['total']
+            stats[metrics.metric(clusterpath, 'clustervmcpu')] = counters['cpu']
+            stats[metrics.metric(clusterpath, 'clustervmram')] = counters['ram'] * 1048576
+        for h, counters in rollups['pod'].values():
+            podpath = (metrics.lower(h['podname']), metrics.slug(h['zonename']))
+            stats[metrics.metric(podpath, 'podvmtotalrunning')] = counters['Running']
+            stats[metrics.metric(podpath, 'podvmtotalstarting')] = counters['Starting']
+            stats[metrics.metric(podpath, 'podvmtotalstopping')] = counters['Stopping']
+            stats[metrics.metric(podpath, 'podvmtotalstopped')] = counters['Stopped']
+            stats[metrics.metric(podpath, 'podvmtotal')] = counters['total']
+            stats[metrics.metric(podpath, 'podvmcpu')] = counters['cpu']
+            stats[metrics.metric(podpath, 'podvmram')] = counters['ram'] * 1048576
 
-    # collect capacity
-    try:
-        capacity = cs_list('listCapacity', 'capacity')
-    except Exception:
-        logger('err', "status err Unable to connect to CloudStack URL at %s for ListCapacity")
+    # only the heaviest accounts, a series per account would not scale;
+    # account names are only unique within their domain
+    if topaccounts:
+        for (domainid, domain, account), count in topaccounts['total']:
+            stats[metrics.metric(('topaccounts', metrics.lower(domain), metrics.lower(account)), 'topaccountvmtotal')] = count
+        for (domainid, domain, account), cpu in topaccounts['cpu']:
+            stats[metrics.metric(('topaccounts', metrics.lower(domain), metrics.lower(account)), 'topaccountvmcpu')] = cpu
+        for (domainid, domain, account), ram in topaccounts['ram']:
+            stats[metrics.metric(('topaccounts', metrics.lower(domain), metrics.lower(account)), 'topaccountvmram')] = ram * 1048576
+
+    if 'zones' in resources:
+        metricnameZonesCount = metrics.metric(('zonescount',), 'zonescount')
+        stats[metricnameZonesCount] = len(zones)
 
-    for c in capacity:
+    # collect accounts
+    if 'accounts' in resources:
+        accounts = resources['accounts']
+        metricnameAccountsTotal = metrics.metric(('accounts',), 'accountscount')
+        metricnameAccountsTotalEnabled = metrics.metric(('accounts',), 'accountenabled')
+        metricnameAccountsTotalDisabled = metrics.metric(('accounts',), 'accountdisabled')
+        stats[metricnameAccountsTotal] = accounts['total']
+        stats[metricnameAccountsTotalEnabled] = accounts['enabled']
+        stats[metricnameAccountsTotalDisabled] = accounts['disabled']
+
+    # collect capacity
+    for c in resources.get('capacity', []):
+        capacitypath = ('zonecapacity', metrics.lower(c['zonename']))
         if c['type'] == 0:
-            metricnameCapaZoneMemoryTotal = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapamemorytotal'])
-            metricnameCapaZoneMemoryUsed = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapamemoryused'])
-            metricnameCapaZoneMemoryPercentUsed = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapamemorypercentused'])
+            metricnameCapaZoneMemoryTotal = metrics.metric(capacitypath, 'zonecapamemorytotal')
+            metricnameCapaZoneMemoryUsed = metrics.metric(capacitypath, 'zonecapamemoryused')
+            metricnameCapaZoneMemoryPercentUsed = metrics.metric(capacitypath, 'zonecapamemorypercentused')
             stats[metricnameCapaZoneMemoryTotal] = c['capacitytotal']
             stats[metricnameCapaZoneMemoryUsed] = c['capacityused']
             stats[metricnameCapaZoneMemoryPercentUsed] = c['percentused']
         elif c['type'] == 1:
-            metricnameCapaZoneCpuTotal = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapacputotal'])
-            metricnameCapaZoneCpuUsed = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapacpuused'])
-            metricnameCapaZoneCpuPercentUsed = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapacpupercentused'])
+            metricnameCapaZoneCpuTotal = metrics.metric(capacitypath, 'zonecapacputotal')
+            metricnameCapaZoneCpuUsed = metrics.metric(capacitypath, 'zonecapacpuused')
+            metricnameCapaZoneCpuPercentUsed = metrics.metric(capacitypath, 'zonecapacpupercentused')
             stats[metricnameCapaZoneCpuTotal] = c['capacitytotal']
             stats[metricnameCapaZoneCpuUsed] = c['capacityused']
             stats[metricnameCapaZoneCpuPercentUsed] = c['percentused']
         elif c['type'] == 2:
-            metricnameCapaZoneDiskTotal = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapadisktotal'])
-            metricnameCapaZoneDiskUsed = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapadiskused'])
-            metricnameCapaZoneDiskPercentUsed = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapadiskpercentused'])
+            metricnameCapaZoneDiskTotal = metrics.metric(capacitypath, 'zonecapadisktotal')
+            metricnameCapaZoneDiskUsed = metrics.metric(capacitypath, 'zonecapadiskused')
+            metricnameCapaZoneDiskPercentUsed = metrics.metric(capacitypath, 'zonecapadiskpercentused')
             stats[metricnameCapaZoneDiskTotal] = c['capacitytotal']
             stats[metricnameCapaZoneDiskUsed] = c['capacityused']
             stats[metricnameCapaZoneDiskPercentUsed] = c['percentused']
         elif c['type'] == 5:
-            metricnameCapaZonePrivateipTotal = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapaprivateiptotal'])
-            metricnameCapaZonePrivateipUsed = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapaprivateipused'])
-            metricnameCapaZonePrivateipPercentUsed = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapaprivateippercentused'])
+            metricnameCapaZonePrivateipTotal = metrics.metric(capacitypath, 'zonecapaprivateiptotal')
+            metricnameCapaZonePrivateipUsed = metrics.metric(capacitypath, 'zonecapaprivateipused')
+            metricnameCapaZonePrivateipPercentUsed = metrics.metric(capacitypath, 'zonecapaprivateippercentused')
             stats[metricnameCapaZonePrivateipTotal] = c['capacitytotal']
             stats[metricnameCapaZonePrivateipUsed] = c['capacityused']
             stats[metricnameCapaZonePrivateipPercentUsed] = c['percentused']
         elif c['type'] == 6:
-            metricnameCapaZoneSSTotal = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapasstotal'])
-            metricnameCapaZoneSSUsed = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapassused'])
-            metricnameCapaZoneSSPercentUsed = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapasspercentused'])
+            metricnameCapaZoneSSTotal = metrics.metric(capacitypath, 'zonecapasstotal')
+            metricnameCapaZoneSSUsed = metrics.metric(capacitypath, 'zonecapassused')
+            metricnameCapaZoneSSPercentUsed = metrics.metric(capacitypath, 'zonecapasspercentused')
             stats[metricnameCapaZoneSSTotal] = c['capacitytotal']
             stats[metricnameCapaZoneSSUsed] = c['capacityused']
             stats[metricnameCapaZoneSSPercentUsed] = c['percentused']
         elif c['type'] == 9:
-            metricnameCapaZoneDiskAllocTotal = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapadiskalloctotal'])
-            metricnameCapaZoneDiskAllocUsed = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapadiskallocused'])
-            metricnameCapaZoneDiskAllocPercentUsed = METRIC_DELIM.join(['zonecapacity', c['zonename'].lower(),  'zonecapadiskallocpercentused'])
+            metricnameCapaZoneDiskAllocTotal = metrics.metric(capacitypath, 'zonecapadiskalloctotal')
+            metricnameCapaZoneDiskAllocUsed = metrics.metric(capacitypath, 'zonecapadiskallocused')
+            metricnameCapaZoneDiskAllocPercentUsed = metrics.metric(capacitypath, 'zonecapadiskallocpercentused')
             stats[metricnameCapaZoneDiskAllocTotal] = c['capacitytotal']
             stats[metricnameCapaZoneDiskAllocUsed] = c['capacityused']
             stats[metricnameCapaZoneDiskAllocPercentUsed] = c['percentused']
 
+    # collect async jobs
+    if 'asyncjobs' in resources:
+        asyncjobs = resources['asyncjobs']
+        metricnameAsyncJobsTotal = metrics.metric(('asyncjobs',), 'asyncjobstotal')
+        stats[metricnameAsyncJobsTotal] = sum(asyncjobs['unfinished'].values())
+        for command, count in asyncjobs['unfinished'].items():
+            stats[metrics.metric(('asyncjobs', metrics.lower(command)), 'asyncjobscount')] = count
+        for q, duration in asyncjobs['durations'].items():
+            if duration is not None:
+                stats[metrics.metric(('asyncjobs',), 'asyncjobsdurationp%d' % q)] = duration
+
     return stats
 
 
+class WarmCache(object):
+    """Last snapshot or VM inventory of an endpoint, kept on disk across restarts.
+
+    The file is a short header followed by a marshal dump of plain values
+    (the typed columns of the inventory as raw bytes), written to a
+    temporary file renamed over the previous one so a crash never leaves
+    a truncated cache behind.
+    """
+
+    MAGIC = 'CSWC\x04'
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        if not data.startswith(self.MAGIC):
+            logger('warn', "ignoring %s, not a cache of this version" % self.path)
+            return None
+        try:
+            return marshal.loads(data[len(self.MAGIC):])
+        except (EOFError, ValueError, TypeError) as e:
+            logger('warn', "ignoring the corrupted cache %s: %s" % (self.path, e))
+            return None
+
+    def save(self, state):
+        tmp = '%s.tmp' % self.path
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(self.MAGIC)
+                f.write(marshal.dumps(state))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            logger('err', "could not write the cache %s: %s" % (self.path, e))
+
+
+def group_values(stats):
+    # one (metric, values) pair per single value metric and per data set,
+    # a value missing from a set is dispatched as unknown (NaN)
+    values = []
+    valuesets = dict()
+    for metric, value in stats.iteritems():
+        if metric.valueset is None:
+            values.append((metric, [value]))
+            continue
+        valueset, position = metric.valueset
+        setvalues = valuesets.get(valueset)
+        if setvalues is None:
+            setvalues = valuesets[valueset] = [float('nan')] * len(VALUE_SETS[valueset.type])
+        setvalues[position] = value
+    values.extend(valuesets.iteritems())
+    return values
+
+
+class Endpoint(object):
+    """A CloudStack region monitored by the module.
+
+    Every endpoint has its own API client pool, database connection,
+    resources, refresh schedule, collector thread and latest snapshot, so
+    a stalled region never delays the snapshots of the others. The metrics
+    (and the self-monitoring values) of a named endpoint are prefixed by
+    its region name, the unnamed endpoint of a configuration without
+    <Endpoint> blocks keeps the historical names.
+    """
+
+    def __init__(self, name, options):
+        self.name = name
+        self.api = options['api'] or DEFAULT_API
+        self.apikey = options['apikey']
+        self.secret = options['secret']
+        self.auth = options['auth']
+        self.workers = options['workers']
+        self.fetch_timeout = options['fetch_timeout']
+        self.stats = SelfStats() if name else SELF_STATS
+        self.metrics = REGISTRY.region(name) if name else REGISTRY
+        self.client = ClientPool(self.api, self.apikey, self.secret, options['pool_size'], API_TIMEOUT, options['max_concurrent_pages'], self.stats)
+
+        self.database = None
+        if options['source'] == 'database':
+            try:
+                if options['db_driver'] == 'sqlite3':
+                    self.database = Database(sqlite_connect(options['db_name']))
+                else:
+                    self.database = Database(mysql_connect(options['db_host'], options['db_user'], options['db_pwd'], options['db_name']))
+            except (ValueError, ImportError) as e:
+                logger('err', "Database source unavailable for %s, falling back to the API: %s" % (self.api, e))
+
+        self.resources = new_resources(self.client, self.database, options['resync_interval'], options['top_accounts'])
+        self.intervals = dict((resource, options['intervals'].get(resource, options['collect_interval'])) for resource in self.resources)
+        self.snapshot = None
+        # last values dispatched and when, per metric key
+        self.sent = dict()
+        self.scheduler = None
+        self.collector = None
+
+        # the snapshot is written at most every CACHE_INTERVAL, the much
+        # larger inventory only when it changed
+        self.cache = None
+        self.inventory_cache = None
+        self.saved_inventory = None
+        self.saved_at = 0
+        self.unsaved = None
+        if CACHE_DIRECTORY:
+            path = os.path.join(CACHE_DIRECTORY, 'cloudstack-%s' % (name or 'default'))
+            self.cache = WarmCache(path + '.cache')
+            self.inventory_cache = WarmCache(path + '.inventory')
+            self.warm_start(self.cache.load(), self.inventory_cache.load())
+
+    def publish(self, stats, timestamp=None):
+        if MULTI_VALUE:
+            values = group_values(stats)
+        else:
+            values = [(metric, [value]) for metric, value in stats.iteritems()]
+        self.snapshot = Snapshot(timestamp or time.time(), tuple(values))
+
+    def save(self, stats, force=False):
+        inventory = self.resources['inventory']
+        if isinstance(inventory, VmInventory) and inventory.saved is not self.saved_inventory:
+            saved = inventory.saved
+            self.inventory_cache.save({'api': self.api, 'inventory': saved})
+            self.saved_inventory = saved
+
+        now = time.time()
+        if not force and now - self.saved_at < CACHE_INTERVAL:
+            self.unsaved = stats
+            return
+        # the snapshot keeps its timestamp, so once reloaded it is
+        # dispatched with its real age
+        offset = len(self.metrics.prefix)
+        self.cache.save({
+            'api': self.api,
+            'snapshot': (self.snapshot.timestamp, [(metric.path[offset:], metric.root, value) for metric, value in stats.iteritems()]),
+        })
+        self.saved_at = now
+        self.unsaved = None
+
+    def warm_start(self, state, inventory_state):
+        # dispatch the last known values until the first collection cycle
+        # completes, and resume the inventory from its events
+        inventory = self.resources['inventory']
+        if isinstance(inventory, VmInventory):
+            inventory.persist = True
+            if inventory_state and inventory_state.get('api') == self.api:
+                try:
+                    inventory.restore(inventory_state['inventory'])
+                    self.saved_inventory = inventory.saved
+                except (KeyError, IndexError, ValueError, TypeError) as e:
+                    logger('warn', "inventory of %s not restored: %s" % (self.api, e))
+                    inventory.reset()
+                    inventory.since = None
+        if not state or state.get('api') != self.api:
+            return
+        timestamp, values = state['snapshot']
+        stats = dict((self.metrics.metric(path, root), value) for path, root, value in values if root in METRIC_TYPES)
+        self.publish(stats, timestamp)
+        logger('verb', "warm start of %s from a %ds old snapshot" % (self.api, time.time() - timestamp))
+
+    def changed(self, values, now):
+        # the values differing from the last ones dispatched, or dispatched
+        # a heartbeat ago so that downstream staleness detection still works,
+        # only the metrics of the current snapshot are remembered
+        previous = self.sent
+        sent = dict()
+        changed = []
+        for metric, metricvalues in values:
+            last = previous.get(metric.key)
+            if last is None or not same_values(last[0], metricvalues) or now - last[1] >= HEARTBEAT:
+                last = (metricvalues, now)
+                changed.append((metric, metricvalues))
+            sent[metric.key] = last
+        self.sent = sent
+        return changed
+
+    def collect_loop(self):
+        scheduler = self.scheduler
+        while not STOP_COLLECTOR.is_set():
+            scheduler.start_due(time.time())
+            scheduler.wakeup.wait(scheduler.next_due(time.time()))
+            scheduler.wakeup.clear()
+            if STOP_COLLECTOR.is_set() or not scheduler.dirty or not scheduler.warm():
+                continue
+
+            # rebuild the whole metric set, resources not refreshed since the
+            # previous snapshot are served from the scheduler cache
+            started = time.time()
+            try:
+                stats = get_stats(self, scheduler.results())
+            except Exception as e:
+                logger('err', "collection cycle of %s failed: %s" % (self.api, e))
+            else:
+                if stats:
+                    self.publish(stats)
+                    if self.cache:
+                        self.save(stats)
+                else:
+                    logger('warn', "%s: No data received from %s" % (NAME, self.api))
+            self.stats.duration('snapshot', time.time() - started)
+
+    def start(self, workers):
+        self.scheduler = ResourceScheduler(self, workers)
+        self.collector = threading.Thread(target=self.collect_loop, name='%s-collector-%s' % (NAME, self.name or 'default'))
+        self.collector.daemon = True
+        self.collector.start()
+
+    def close(self):
+        if self.scheduler:
+            self.scheduler.wakeup.set()
+        if self.collector:
+            self.collector.join(API_TIMEOUT)
+        if self.unsaved:
+            self.save(self.unsaved, force=True)
+        self.client.close()
+        if self.database:
+            self.database.close()
+
+
+def new_endpoint_options():
+    return {
+        'api': '',
+        'apikey': DEFAULT_APIKEY,
+        'secret': DEFAULT_SECRET,
+        'auth': DEFAULT_AUTH,
+        'max_concurrent_pages': MAX_CONCURRENT_PAGES,
+        'pool_size': POOL_SIZE,
+        'workers': ENDPOINT_WORKERS,
+        'collect_interval': COLLECT_INTERVAL,
+        'fetch_timeout': FETCH_TIMEOUT,
+        'resync_interval': RESYNC_INTERVAL,
+        'top_accounts': TOP_ACCOUNTS,
+        'intervals': dict(),
+        'source': SOURCE,
+        'db_driver': DB_DRIVER,
+        'db_host': DB_HOST,
+        'db_user': DB_USER,
+        'db_pwd': DB_PWD,
+        'db_name': DB_NAME,
+    }
+
+
+def configure_endpoint(options, node):
+    # apply a setting of an endpoint, returns False if node is not one
+    if node.key == "Api":
+        options['api'] = node.values[0]
+    elif node.key == "ApiKey":
+        options['apikey'] = node.values[0]
+    elif node.key == "Secret":
+        options['secret'] = node.values[0]
+    elif node.key == "Auth":
+        options['auth'] = node.values[0]
+    elif node.key == "MaxConcurrentPages":
+        options['max_concurrent_pages'] = max(1, int(node.values[0]))
+    elif node.key == "PoolSize":
+        options['pool_size'] = max(1, int(node.values[0]))
+    elif node.key == "Workers":
+        options['workers'] = max(1, int(node.values[0]))
+    elif node.key == "CollectInterval":
+        options['collect_interval'] = int(node.values[0])
+    elif node.key == "FetchTimeout":
+        options['fetch_timeout'] = int(node.values[0])
+    elif node.key == "ResyncInterval":
+        options['resync_interval'] = int(node.values[0])
+    elif node.key == "TopAccounts":
+        options['top_accounts'] = max(0, int(node.values[0]))
+    elif node.key in RESOURCE_INTERVAL_KEYS:
+        options['intervals'][RESOURCE_INTERVAL_KEYS[node.key]] = int(node.values[0])
+    elif node.key == "Source":
+        options['source'] = node.values[0].lower()
+    elif node.key == "DbDriver":
+        options['db_driver'] = node.values[0].lower()
+    elif node.key == "DbHost":
+        options['db_host'] = node.values[0]
+    elif node.key == "DbUser":
+        options['db_user'] = node.values[0]
+    elif node.key == "DbPwd":
+        options['db_pwd'] = node.values[0]
+    elif node.key == "DbName":
+        options['db_name'] = node.values[0]
+    else:
+        return False
+    return True
+
+
 # callback configuration for module
 def configure_callback(conf):
-    global API_MONITORS, APIKEY_MONITORS, SECRET_MONITORS, AUTH_MONITORS, VERBOSE_LOGGING, SKIP
-    API_MONITORS = ''
-    APIKEY_MONITORS = ''
-    SECRET_MONITORS = ''
-    AUTH_MONITORS = DEFAULT_AUTH
+    global VERBOSE_LOGGING, MAX_SNAPSHOT_AGE, MULTI_VALUE, HEARTBEAT, CACHE_DIRECTORY, CACHE_INTERVAL, ENDPOINTS
     VERBOSE_LOGGING = False
-    SKIP = 10
 
+    # the top level settings are the defaults of the <Endpoint> blocks
+    defaults = new_endpoint_options()
+    blocks = []
     for node in conf.children:
-        if node.key == "Api":
-            API_MONITORS = node.values[0]
-        elif node.key == "ApiKey":
-            APIKEY_MONITORS = node.values[0]
-        elif node.key == "Secret":
-            SECRET_MONITORS = node.values[0]
-        elif node.key == "Auth":
-            AUTH_MONITORS = node.values[0]
+        if node.key == "Endpoint":
+            blocks.append(node)
         elif node.key == "Verbose":
             VERBOSE_LOGGING = bool(node.values[0])
-        elif node.key == "Skip":
-            SKIP = int(node.values[0])
-        else:
+        elif node.key == "MaxSnapshotAge":
+            MAX_SNAPSHOT_AGE = int(node.values[0])
+        elif node.key == "MultiValue":
+            MULTI_VALUE = bool(node.values[0])
+        elif node.key == "Heartbeat":
+            HEARTBEAT = int(node.values[0])
+        elif node.key == "CacheDirectory":
+            CACHE_DIRECTORY = node.values[0]
+        elif node.key == "CacheInterval":
+            CACHE_INTERVAL = int(node.values[0])
+        elif not configure_endpoint(defaults, node):
             logger('warn', 'Unknown config key: %s' % node.key)
 
-    if not API_MONITORS:
-        API_MONITORS += DEFAULT_API
+    for endpoint in ENDPOINTS:
+        endpoint.close()
+    ENDPOINTS = []
+
+    if not blocks:
+        ENDPOINTS.append(Endpoint('', defaults))
+    for block in blocks:
+        name = REGISTRY.slug(block.values[0]) if block.values else ''
+        if not name or name in [endpoint.name for endpoint in ENDPOINTS]:
+            logger('err', "Endpoint blocks need a unique region name, ignoring %r" % (block.values,))
+            continue
+        options = copy.deepcopy(defaults)
+        for node in block.children:
+            if not configure_endpoint(options, node):
+                logger('warn', 'Unknown config key in endpoint %s: %s' % (name, node.key))
+        ENDPOINTS.append(Endpoint(name, options))
+
+    # a result is served until the next refresh lands, at most an interval
+    # and a FetchTimeout after its own refresh started
+    for endpoint in ENDPOINTS:
+        for resource, interval in sorted(endpoint.intervals.items()):
+            if interval + endpoint.fetch_timeout >= MAX_SNAPSHOT_AGE:
+                logger('warn', "%s: the %s interval (%ss) plus FetchTimeout (%ss) of %s reach MaxSnapshotAge (%ss), "
+                       "its metrics will be missing between refreshes" % (NAME, resource, interval, endpoint.fetch_timeout, endpoint.api, MAX_SNAPSHOT_AGE))
+
+
+def init_callback():
+    global WORKERS
+    STOP_COLLECTOR.clear()
+    # every endpoint has its own share of the pool
+    WORKERS = WorkerPool(sum(endpoint.workers for endpoint in ENDPOINTS))
+    for endpoint in ENDPOINTS:
+        endpoint.start(WORKERS)
+
+
+def shutdown_callback():
+    STOP_COLLECTOR.set()
+    for endpoint in ENDPOINTS:
+        endpoint.close()
+    if WORKERS:
+        WORKERS.close()
+
+
+def dispatch_stat(metric, values):
+    if VERBOSE_LOGGING:
+        logger('verb', "read_callback key %s values %s" % (metric.key, values))
+    val = collectd.Values(plugin=NAME, type=metric.type)
+    val.type_instance = metric.type_instance
+    val.values = values
+    val.dispatch()
+    return len(values)
+
+
+def dispatch_self_stats():
+    sources = [('', SELF_STATS)] + [(endpoint.name + METRIC_DELIM, endpoint.stats) for endpoint in ENDPOINTS if endpoint.name]
+    for prefix, stats in sources:
+        for val_type, type_instance, value in stats.collect():
+            val = collectd.Values(plugin=NAME, plugin_instance='self', type=val_type)
+            val.type_instance = prefix + type_instance
+            val.values = [value]
+            val.dispatch()
 
 
 def read_callback():
-    global RUN, SKIP
-    RUN += 1
-    if RUN % SKIP != 1:
-        return
     logger('verb', "beginning read_callback")
-    info = get_stats()
-
-    if not info:
-        logger('warn', "%s: No data received" % NAME)
-        return
-
-    for key, value in info.items():
-        key_prefix = ''
-        key_root = key
-        logger('verb', "read_callback key %s" % (key))
-        logger('verb', "read_callback value %s" % (value))
-        if value not in METRIC_TYPES:
-            try:
-                key_prefix, key_root = key.rsplit(METRIC_DELIM, 1)
-            except ValueError:
-                pass
-        if key_root not in METRIC_TYPES:
+    # never call the API from here, only dispatch what the collectors published
+    started = time.time()
+    dispatched = 0
+    dispatches = 0
+    suppressed = 0
+
+    for endpoint in ENDPOINTS:
+        snapshot = endpoint.snapshot
+        if snapshot is None:
+            logger('warn', "%s: No data received from %s" % (NAME, endpoint.api))
+            continue
+        age = time.time() - snapshot.timestamp
+        dispatched += dispatch_stat(endpoint.metrics.metric(('collector',), 'snapshotage'), [age])
+        dispatches += 1
+        if age > MAX_SNAPSHOT_AGE:
+            logger('warn', "%s: latest snapshot of %s is %ds old, not dispatching it" % (NAME, endpoint.api, age))
             continue
+        values = snapshot.values
+        if HEARTBEAT:
+            values = endpoint.changed(values, started)
+            suppressed += len(snapshot.values) - len(values)
+        for metric, metricvalues in values:
+            dispatched += dispatch_stat(metric, metricvalues)
+        dispatches += len(values)
 
-        key_root, val_type = METRIC_TYPES[key_root]
-        key_name = METRIC_DELIM.join([key_prefix, key_root])
-        logger('verb', "key_name %s" % (key_name))
-        val = collectd.Values(plugin=NAME, type=val_type)
-        val.type_instance = key_name
-        val.values = [value]
-        val.dispatch()
+    SELF_STATS.duration('dispatch', time.time() - started)
+    SELF_STATS.count('dispatched', dispatched)
+    SELF_STATS.count('dispatches', dispatches)
+    SELF_STATS.count('suppressed', suppressed)
+    dispatch_self_stats()
 
 
 # logging function
 def logger(t, msg):
-    if t == 'err':
+    if collectd is None:
+        if t != 'verb' or VERBOSE_LOGGING:
+            sys.stderr.write('%s: %s: %s\n' % (NAME, t, msg))
+    elif t == 'err':
         collectd.error('%s: %s' % (NAME, msg))
     elif t == 'warn':
         collectd.warning('%s: %s' % (NAME, msg))
@@ -447,5 +2037,8 @@ def logger(t, msg):
     else:
         collectd.notice('%s: %s' % (NAME, msg))
 # main
-collectd.register_config(configure_callback)
-collectd.register_read(read_callback)
+if collectd is not None:
+    collectd.register_config(configure_callback)
+    collectd.register_init(init_callback)
+    collectd.register_read(read_callback)
+    collectd.register_shutdown(shutdown_callback)
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+
+# collectd-cloudstack - cloudstack_exporter.py
+#
+# Description : Standalone Prometheus exporter running the collectors of
+# cloudstack.py outside of collectd.
+#
+# The collector threads refresh the snapshots on their own schedule, exactly
+# as inside collectd. A scrape only renders the latest snapshots (once per
+# new snapshot) from memory and never calls the API, so any number of
+# scrapers share one collection. The self-monitoring values are rendered on
+# every scrape, their latency percentiles cover the API calls since the
+# previous one.
+#
+# Usage: cloudstack_exporter.py [--address A] [--port P] --option Api=URL --option ApiKey=KEY --option Secret=SECRET
+#        cloudstack_exporter.py --option ApiKey=KEY --option Secret=SECRET --option ch-gva-2/Api=URL --option de-fra-1/Api=URL
+
+import re
+import sys
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import cloudstack
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# family name and Prometheus type of the self-monitoring values per collectd type
+SELF_FAMILIES = {
+    'derive': ('cloudstack_self_total', 'counter'),
+    'duration': ('cloudstack_self_duration_seconds', 'gauge'),
+    'count': ('cloudstack_self_count', 'gauge'),
+}
+
+
+class ConfigNode(object):
+    def __init__(self, key, values, children=()):
+        self.key = key
+        self.values = values
+        self.children = list(children)
+
+
+def config_value(text):
+    # typed like collectd passes the values of its configuration
+    if text.lower() in ('true', 'false'):
+        return text.lower() == 'true'
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+def config_tree(options):
+    """Module configuration of the `Key=Value` options, `region/Key=Value`
+    ones go to the <Endpoint "region"> block."""
+    children = []
+    blocks = dict()
+    for option in options:
+        key, value = option.split('=', 1)
+        node = ConfigNode(key.rsplit('/', 1)[-1], [config_value(value)])
+        if '/' in key:
+            region = key.split('/', 1)[0]
+            if region not in blocks:
+                blocks[region] = ConfigNode('Endpoint', [region])
+                children.append(blocks[region])
+            blocks[region].children.append(node)
+        else:
+            children.append(node)
+    return ConfigNode('Module', [], children)
+
+
+def entity_labels(root):
+    # label names of the entity path of a metric, None for its constant parts
+    if root.startswith('clustervm'):
+        return ('cluster', 'pod', 'zone')
+    if root.startswith('podvm'):
+        return ('pod', 'zone')
+    if root == 'activeviewersessions':
+        return (None, 'zone', 'systemvm')
+    if root.startswith('zone') and root != 'zonescount':
+        return (None, 'zone')
+    if root.startswith('topaccount'):
+        return (None, 'domain', 'account')
+    if root == 'asyncjobscount':
+        return (None, 'command')
+    if root.startswith(('hvm', 'memory', 'cpuallocated')):
+        return ('host', 'pod', 'zone')
+    return ()
+
+
+LABELS = dict((root, entity_labels(root)) for root in cloudstack.METRIC_TYPES)
+
+
+def label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def sample(name, labels, value):
+    if labels:
+        return '%s{%s} %r' % (name, ','.join('%s="%s"' % (label, label_value(v)) for label, v in labels), value)
+    return '%s %r' % (name, value)
+
+
+def render_snapshot(endpoint, snapshot, families):
+    # add the samples of a snapshot to the {name: (type, samples)} families
+    offset = len(endpoint.metrics.prefix)
+    region = [('region', endpoint.name)] if endpoint.name else []
+    for metric, values in snapshot.values:
+        try:
+            value = float(values[0])
+        except (TypeError, ValueError):
+            continue
+        type_instance, val_type = cloudstack.METRIC_TYPES[metric.root]
+        name = 'cloudstack_' + re.sub(r'[^a-zA-Z0-9_]', '_', type_instance)
+        labels = region + [(label, v) for label, v in zip(LABELS[metric.root], metric.path[offset:]) if label]
+        family = families.get(name)
+        if family is None:
+            family = families[name] = ('counter' if val_type == 'derive' else 'gauge', [])
+        family[1].append(sample(name, labels, value))
+
+
+def render_self_stats(endpoints, families):
+    # collecting the self stats resets their latencies, like a collectd read
+    sources = [([], cloudstack.SELF_STATS)] + [([('region', endpoint.name)], endpoint.stats) for endpoint in endpoints if endpoint.name]
+    for labels, stats in sources:
+        for val_type, type_instance, value in stats.collect():
+            name, family_type = SELF_FAMILIES[val_type]
+            family = families.get(name)
+            if family is None:
+                family = families[name] = (family_type, [])
+            family[1].append(sample(name, labels + [('measure', type_instance)], value))
+
+
+def render_families(families):
+    lines = []
+    for name in sorted(families):
+        lines.append('# TYPE %s %s' % (name, families[name][0]))
+        lines.extend(sorted(families[name][1]))
+    return ''.join(line + '\n' for line in lines)
+
+
+class Exporter(object):
+    """Prometheus text of the latest snapshots of the endpoints.
+
+    The text is rendered again only when an endpoint published a new
+    snapshot, the snapshot ages and the self stats are the only samples
+    computed per scrape.
+    """
+
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self.lock = threading.Lock()
+        self.snapshots = None
+        self.text = ''
+
+    def render(self):
+        now = time.time()
+        snapshots = tuple(endpoint.snapshot for endpoint in self.endpoints)
+        # like the read callback, a snapshot too old is not exported
+        fresh = tuple(snapshot if snapshot and now - snapshot.timestamp <= cloudstack.MAX_SNAPSHOT_AGE else None
+                      for snapshot in snapshots)
+        with self.lock:
+            if fresh != self.snapshots:
+                families = dict()
+                for endpoint, snapshot in zip(self.endpoints, fresh):
+                    if snapshot is not None:
+                        render_snapshot(endpoint, snapshot, families)
+                self.text = render_families(families)
+                self.snapshots = fresh
+            text = self.text
+            families = dict()
+            render_self_stats(self.endpoints, families)
+            text += render_families(families)
+
+        ages = ['# TYPE cloudstack_snapshot_age_seconds gauge']
+        for endpoint, snapshot in zip(self.endpoints, snapshots):
+            if snapshot is not None:
+                labels = [('region', endpoint.name)] if endpoint.name else []
+                ages.append(sample('cloudstack_snapshot_age_seconds', labels, now - snapshot.timestamp))
+        return text + ''.join(line + '\n' for line in ages)
+
+
+class ExporterHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        payload = self.server.exporter.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class ExporterServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, exporter):
+        HTTPServer.__init__(self, address, ExporterHandler)
+        self.exporter = exporter
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve the CloudStack metrics of cloudstack.py to Prometheus")
+    parser.add_argument('--address', default='', help="address to listen on, all of them by default")
+    parser.add_argument('--port', type=int, default=9591)
+    parser.add_argument('--option', action='append', default=[], help="cloudstack module option, e.g. Api=URL, or region/Api=URL for an Endpoint block")
+    args = parser.parse_args(argv)
+    # every metric is a sample of its own, Prometheus has no multi-value sets
+    if any(option.split('=', 1)[0].rsplit('/', 1)[-1] == 'MultiValue' for option in args.option):
+        parser.error("MultiValue is not supported, Prometheus has no multi-value data sets")
+
+    # set before the endpoints publish the snapshot of their warm-start cache
+    cloudstack.MULTI_VALUE = False
+    cloudstack.configure_callback(config_tree(args.option))
+    cloudstack.init_callback()
+    server = ExporterServer((args.address, args.port), Exporter(cloudstack.ENDPOINTS))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        cloudstack.shutdown_callback()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
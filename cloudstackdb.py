@@ -0,0 +1,64 @@
+# collectd-cloudstack - cloudstackdb.py
+#
+# Description : Connection to the CloudStack database shared by csinstancesstats.py
+# and the "database" source of cloudstack.py
+
+
+try:
+    import MySQLdb
+except ImportError:
+    # only needed to connect to MySQL, a sqlite3 stand-in works without it
+    MySQLdb = None
+
+
+class Database(object):
+    """Persistent connection to the cloud database, reopened after a failure.
+
+    `connect` is any callable returning a DB-API connection, so a sqlite3
+    database loaded with synthetic tables can stand in for MySQL.
+    """
+
+    def __init__(self, connect):
+        self.connect = connect
+        self.con = None
+
+    def close(self):
+        if self.con is not None:
+            try:
+                self.con.close()
+            except Exception:
+                pass
+            self.con = None
+
+    def query(self, sql):
+        for attempt in (1, 2):
+            try:
+                if self.con is None:
+                    self.con = self.connect()
+                cursor = self.con.cursor()
+                try:
+                    cursor.execute(sql)
+                    rows = cursor.fetchall()
+                finally:
+                    cursor.close()
+                # end the read transaction so the next query sees fresh data
+                self.con.commit()
+                return rows
+            except Exception:
+                self.close()
+                if attempt == 2:
+                    raise
+
+
+def mysql_connect(dbhost, user, pwd, database):
+    if not (dbhost and user and pwd and database):
+        raise ValueError("empty parameter, dbhost: %s , user: %s , database: %s" % (dbhost, user, database))
+    if MySQLdb is None:
+        raise ImportError("MySQLdb is required to connect to %s" % dbhost)
+    return lambda: MySQLdb.connect(dbhost, user, pwd, database)
+
+
+def sqlite_connect(path):
+    import sqlite3
+    # the connection is opened by the collector thread but may be reused by another one
+    return lambda: sqlite3.connect(path, check_same_thread=False)
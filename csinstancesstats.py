@@ -3,35 +3,48 @@
 # collectd-cloudstack - csinstancesstats.py
 #
 # Author : Loic Lambiel @ exoscale
-# Description : This is a collectd python module to gather the total spawned instances on cloudstack
+# Description : This is a collectd python module to gather the spawned instances on cloudstack,
+# broken down by type, state, zone and hypervisor host
 
 
-import MySQLdb
+import re
 import sys
 
+from cloudstackdb import Database, mysql_connect, sqlite_connect
+
 RUN = 0
 
-def get_nb_instances(dbhost, user, pwd, database):
-    if not (dbhost and user and pwd and database):
-        logger('error', "empty parameter, dbhost: %s , user: %s , pwd: %s , database: %s" % (dbhost, user, pwd, database))
-        sys.exit(1)
-    try:
-        QUERYNBINSTANCES = "SELECT id FROM cloud.vm_instance where type like 'User';"
-        con = MySQLdb.connect(dbhost, user, pwd, database)
-        cursor = con.cursor()
-        cursor.execute(QUERYNBINSTANCES)
-        querycount = cursor.rowcount
-        CSStats = {}
-        CSStats['nbinstances'] = querycount
-        return CSStats
-
-    except ValueError as e:
-        logger('error', "Error during mysql query: %s" % e)
-        sys.exit(1)
-
-    finally:
-        if con:
-            con.close()
+# one grouped query per cycle, the counting happens on the database server;
+# expunged instances keep their row with a removed date, they only count in
+# total-created-instances
+QUERYINSTANCES = """SELECT vm.type, vm.state, dc.name, h.name, COUNT(*), SUM(vm.removed IS NULL)
+FROM vm_instance vm
+LEFT JOIN data_center dc ON dc.id = vm.data_center_id
+LEFT JOIN host h ON h.id = vm.host_id
+GROUP BY vm.type, vm.state, dc.name, h.name"""
+
+
+def normalize(name):
+    return re.sub(r"\s+", '-', str(name).lower())
+
+
+def get_instances_stats(db):
+    CSStats = {}
+    for vmtype, state, zone, host, count, present in db.query(QUERYINSTANCES):
+        vmtype = normalize(vmtype)
+        state = normalize(state)
+        present = int(present or 0)
+        if vmtype == 'user':
+            CSStats['total-created-instances'] = CSStats.get('total-created-instances', 0) + count
+        if not present:
+            continue
+        keys = ['instances-%s-%s' % (vmtype, state), 'zone-%s-%s-%s' % (normalize(zone), vmtype, state)]
+        if host is not None:
+            keys.append('host-%s-%s-%s' % (normalize(host), vmtype, state))
+        for key in keys:
+            CSStats[key] = CSStats.get(key, 0) + present
+    CSStats.setdefault('total-created-instances', 0)
+    return CSStats
 
 
 try:
@@ -45,9 +58,10 @@ try:
     user = ""
     pwd = ""
     database = ""
+    DB = None
 
     def config_callback(conf):
-        global dbhost, user, pwd, database, VERBOSE_LOGGING, SKIP
+        global dbhost, user, pwd, database, VERBOSE_LOGGING, SKIP, DB
         for node in conf.children:
             logger('verb', "Node key: %s and value %s" % (node.key, node.values[0]))
             if node.key == "DbHost":
@@ -64,19 +78,31 @@ try:
                 SKIP = int(node.values[0])
             else:
                 logger('warn', "unknown config key in puppet module: %s" % node.key)
+        try:
+            DB = Database(mysql_connect(dbhost, user, pwd, database))
+        except (ValueError, ImportError) as e:
+            logger('err', "%s" % e)
 
     def read_callback():
         global RUN, SKIP
         RUN += 1
-        if RUN % SKIP != 1:
+        if RUN % SKIP != 1 or DB is None:
+            return
+        try:
+            cs_stats = get_instances_stats(DB)
+        except Exception as e:
+            logger('err', "Error during mysql query: %s" % e)
             return
-        cs_stats = get_nb_instances(dbhost, user, pwd, database)
-        val = collectd.Values(plugin=NAME, type="gauge")
-        val.values = [cs_stats['nbinstances']]
-        logger('verb', "Nb of instances: %s" % cs_stats['nbinstances'])
-        val.type_instance = "total-created-instances"
-        val.type = "gauge"
-        val.dispatch()
+        logger('verb', "Nb of instances: %s" % cs_stats['total-created-instances'])
+        for key, value in cs_stats.items():
+            val = collectd.Values(plugin=NAME, type="gauge")
+            val.type_instance = key
+            val.values = [value]
+            val.dispatch()
+
+    def shutdown_callback():
+        if DB is not None:
+            DB.close()
 
     # logging function
     def logger(t, msg):
@@ -92,6 +118,7 @@ try:
 
     collectd.register_config(config_callback)
     collectd.register_read(read_callback)
+    collectd.register_shutdown(shutdown_callback)
 
 
 except ImportError:
@@ -100,10 +127,12 @@ except ImportError:
     pass
 
 if __name__ == "__main__":
-    dbhost = sys.argv[1]
-    user = sys.argv[2]
-    pwd = sys.argv[3]
-    database = sys.argv[4]
-    cs_stats = get_nb_instances(dbhost, user, pwd, database)
-
-    print "The number of instances is %s" % (cs_stats['nbinstances'])
+    if sys.argv[1] == "--sqlite":
+        db = Database(sqlite_connect(sys.argv[2]))
+    else:
+        db = Database(mysql_connect(*sys.argv[1:5]))
+    cs_stats = get_instances_stats(db)
+
+    print "The number of instances is %s" % (cs_stats['total-created-instances'])
+    for key in sorted(cs_stats):
+        print "%s %s" % (key, cs_stats[key])